@@ -3,15 +3,81 @@ Migration Utility - Convert JSON state files to SQLite database
 """
 
 import os
-import json
 import glob
-from modules.state_manager import StateManager
+from concurrent.futures import ProcessPoolExecutor, wait
+from itertools import chain
+from multiprocessing import Manager
+from queue import Empty
+from modules.state_manager import StateManager, iter_chunks, iter_json_state, remove_database
 from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn
 
 console = Console()
 
 
+def _migrate_entries(json_file: str, db_file: str, on_batch=None) -> int:
+    """
+    Copie en flux les entrées d'un fichier JSON state dans la base SQLite.
+    Aucun affichage (utilisable dans un processus worker).
+    Retourne le nombre d'entrées migrées (0 si le fichier est vide).
+    """
+    with open(json_file, 'rb') as f:
+        entries = iter_json_state(f)
+        first = next(entries, None)
+        
+        if first is None:
+            return 0
+        
+        # Base neuve : chargement sans journal (le JSON reste la source en cas d'échec)
+        fresh = not os.path.exists(db_file)
+        state_manager = StateManager(db_file)
+        count = 0
+        
+        # Migrer par batch, sans matérialiser tout le fichier (une seule transaction)
+        batch_size = 1000
+        try:
+            with state_manager.transaction(bulk=fresh):
+                for batch in iter_chunks(chain([first], entries), batch_size):
+                    state_manager.update_file_batch_iter(batch, batch_size=batch_size)
+                    count += len(batch)
+                    if on_batch:
+                        on_batch(len(batch))
+        except BaseException:
+            if fresh:
+                remove_database(db_file)  # base à moitié chargée : inutilisable
+            raise
+        
+        state_manager.optimize()
+    
+    return count
+
+
+def _migrate_one(job):
+    """Worker de migrate_all_state_files (fonction de module : picklable)"""
+    json_file, db_file, progress_queue = job
+    try:
+        count = _migrate_entries(
+            json_file, db_file,
+            on_batch=lambda n: progress_queue.put((json_file, n))
+        )
+        return json_file, db_file, count, None
+    except Exception as e:
+        return json_file, db_file, 0, str(e)
+
+
+def _report_migration(json_file: str, db_file: str):
+    """Affiche les statistiques d'une migration réussie et archive le JSON"""
+    stats = StateManager(db_file).get_statistics()
+    console.print(f"[green]✅ Migration completed: {json_file} → {db_file}[/green]")
+    console.print(f"[dim]   Files in database: {stats['total_files']:,}[/dim]")
+    console.print(f"[dim]   Database size: {stats['database_size_mb']:.2f} MB[/dim]")
+    
+    # Renommer l'ancien fichier JSON
+    backup_name = json_file + ".migrated_backup"
+    os.rename(json_file, backup_name)
+    console.print(f"[dim]   Original JSON backed up to: {backup_name}[/dim]\n")
+
+
 def migrate_json_to_sqlite(json_file: str, db_file: str):
     """
     Migre un fichier JSON state vers une base SQLite
@@ -22,48 +88,25 @@ def migrate_json_to_sqlite(json_file: str, db_file: str):
     """
     console.print(f"[cyan]Migrating {json_file} → {db_file}[/cyan]")
     
-    # Charger le JSON
     try:
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-        
-        if not data:
-            console.print(f"[yellow]⚠️  Empty file, skipping[/yellow]\n")
-            return
-        
-        console.print(f"[dim]   Loaded {len(data):,} entries from JSON[/dim]")
-        
-        # Créer le state manager
-        state_manager = StateManager(db_file)
-        
-        # Migrer par batch
         with Progress(
             SpinnerColumn(),
             TextColumn("[progress.description]{task.description}"),
             BarColumn(),
-            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+            TextColumn("{task.completed:,} entries"),
             console=console
         ) as progress:
-            task = progress.add_task("[cyan]Migrating...", total=len(data))
-            
-            batch_size = 1000
-            items = list(data.items())
-            
-            for i in range(0, len(items), batch_size):
-                batch = dict(items[i:i+batch_size])
-                state_manager.update_file_batch(batch, batch_size=batch_size)
-                progress.update(task, advance=len(batch))
+            task = progress.add_task("[cyan]Migrating...", total=None)
+            count = _migrate_entries(
+                json_file, db_file,
+                on_batch=lambda n: progress.update(task, advance=n)
+            )
         
-        # Statistiques
-        stats = state_manager.get_statistics()
-        console.print(f"[green]✅ Migration completed[/green]")
-        console.print(f"[dim]   Files in database: {stats['total_files']:,}[/dim]")
-        console.print(f"[dim]   Database size: {stats['database_size_mb']:.2f} MB[/dim]")
+        if count == 0:
+            console.print(f"[yellow]⚠️  Empty file, skipping[/yellow]\n")
+            return
         
-        # Renommer l'ancien fichier JSON
-        backup_name = json_file + ".migrated_backup"
-        os.rename(json_file, backup_name)
-        console.print(f"[dim]   Original JSON backed up to: {backup_name}[/dim]\n")
+        _report_migration(json_file, db_file)
         
     except Exception as e:
         console.print(f"[red]❌ Migration failed: {e}[/red]\n")
@@ -72,6 +115,7 @@ def migrate_json_to_sqlite(json_file: str, db_file: str):
 def migrate_all_state_files():
     """
     Migre automatiquement tous les fichiers state_*.json trouvés
+    (un processus par fichier : les migrations sont indépendantes)
     """
     console.print("\n[bold cyan]🔄 STATE FILE MIGRATION UTILITY[/bold cyan]\n")
     console.print("Searching for state_*.json files...\n")
@@ -85,6 +129,7 @@ def migrate_all_state_files():
     
     console.print(f"[green]Found {len(json_files)} file(s) to migrate:[/green]\n")
     
+    jobs = []
     for json_file in json_files:
         # Générer le nom de la base SQLite
         base_name = os.path.splitext(json_file)[0]
@@ -95,8 +140,49 @@ def migrate_all_state_files():
             console.print(f"[yellow]⚠️  {json_file} → {db_file} already exists, skipping[/yellow]\n")
             continue
         
-        # Migrer
-        migrate_json_to_sqlite(json_file, db_file)
+        jobs.append((json_file, db_file))
+    
+    if len(jobs) == 1:
+        migrate_json_to_sqlite(*jobs[0])
+    elif jobs:
+        results = []
+        with Manager() as manager:
+            progress_queue = manager.Queue()
+            
+            with Progress(
+                SpinnerColumn(),
+                TextColumn("[progress.description]{task.description}"),
+                BarColumn(),
+                TextColumn("{task.completed:,} entries"),
+                console=console
+            ) as progress, ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+                tasks = {
+                    json_file: progress.add_task(f"[cyan]{json_file}", total=None)
+                    for json_file, db_file in jobs
+                }
+                pending = {
+                    executor.submit(_migrate_one, (json_file, db_file, progress_queue))
+                    for json_file, db_file in jobs
+                }
+                
+                # Les workers n'affichent rien : la barre est mise à jour ici
+                while pending:
+                    done, pending = wait(pending, timeout=0.2)
+                    while True:
+                        try:
+                            json_file, advance = progress_queue.get_nowait()
+                        except Empty:
+                            break
+                        progress.update(tasks[json_file], advance=advance)
+                    results.extend(future.result() for future in done)
+        
+        for json_file, db_file, count, error in results:
+            if error:
+                console.print(f"[red]❌ Migration failed for {json_file}: {error}[/red]\n")
+            elif count == 0:
+                console.print(f"[yellow]⚠️  {json_file} is empty, skipping[/yellow]\n")
+            else:
+                _report_migration(json_file, db_file)
     
     console.print("[bold green]✅ All migrations completed![/bold green]\n")
 
@@ -107,31 +193,31 @@ def compare_json_sqlite(json_file: str, db_file: str):
     """
     console.print(f"\n[cyan]Comparing {json_file} with {db_file}...[/cyan]\n")
     
-    # Charger JSON
-    with open(json_file, 'r') as f:
-        json_data = json.load(f)
+    # Lire le JSON en flux : seules les clés (et un échantillon) sont gardées
+    sample_size = 100
+    json_keys = set()
+    json_sample = {}
+    with open(json_file, 'rb') as f:
+        for rel_path, size, modify in iter_json_state(f):
+            json_keys.add(rel_path)
+            if len(json_sample) < sample_size:
+                json_sample[rel_path] = (size, modify)
     
-    # Charger SQLite
+    # Clés SQLite (curseur parcouru en flux, sans charger les valeurs)
     state_manager = StateManager(db_file)
-    db_data = state_manager.get_all_files()
-    
-    # Comparer
-    json_keys = set(json_data.keys())
-    db_keys = set(db_data.keys())
+    db_keys = state_manager.get_files_set()
     
     if json_keys == db_keys:
         console.print(f"[green]✅ File count matches: {len(json_keys):,} files[/green]")
         
-        # Vérifier quelques entrées
-        sample_size = min(100, len(json_keys))
+        # Vérifier quelques entrées (une requête IN pour tout l'échantillon)
+        sample_size = len(json_sample)
+        db_sample = state_manager.get_file_states(list(json_sample))
         mismatches = 0
         
-        for key in list(json_keys)[:sample_size]:
-            json_entry = json_data[key]
-            db_entry = db_data[key]
-            
-            if (json_entry.get('size') != db_entry.get('size') or 
-                json_entry.get('modify') != db_entry.get('modify')):
+        for key, (size, modify) in json_sample.items():
+            db_entry = db_sample.get(key, {})
+            if size != db_entry.get('size') or modify != db_entry.get('modify'):
                 mismatches += 1
         
         if mismatches == 0:
@@ -1,12 +1,161 @@
 import os
+import posixpath
 import json
+import sys
+import queue
+import select
+import threading
+from collections import Counter
+from functools import partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from rich.table import Table
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TransferSpeedColumn, TimeRemainingColumn
 
-from modules.core import console
+from modules.core import console, TRANSFER_BLOCKSIZE
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+PROGRESS_FLUSH_BYTES = 1 << 20
+PREALLOCATE_MIN_BYTES = 64 * 1024 * 1024
+# splice() socket → pipe → fichier (Linux) : les données ne passent plus par Python
+SPLICE_MIN_BYTES = 4 * 1024 * 1024
+# En SFTP, au-delà de ce nombre de fichiers, un seul flux tar remplace les transferts unitaires
+TAR_STREAM_THRESHOLD = 500
+HAS_SPLICE = hasattr(os, 'splice') and sys.platform.startswith('linux')
+
+
+class _ChunkSink:
+    """
+    Callback de transfert : écrit chaque bloc et ne remonte la progression
+    à Rich que par paquets de PROGRESS_FLUSH_BYTES (appeler flush() en fin de transfert).
+    received compte les octets reçus pour la vérification d'intégrité.
+    """
+    __slots__ = ('write', 'advance', 'acc', 'received')
+    
+    def __init__(self, f, progress, task_id):
+        self.write = f.write
+        self.advance = partial(progress.update, task_id)
+        self.acc = 0
+        self.received = 0
+    
+    def __call__(self, data):
+        self.write(data)
+        n = len(data)
+        self.received += n
+        self.acc += n
+        if self.acc >= PROGRESS_FLUSH_BYTES:
+            self.advance(advance=self.acc)
+            self.acc = 0
+    
+    def count(self, n):
+        """Octets écrits hors Python (splice) : progression et compteur seulement"""
+        self.received += n
+        self.acc += n
+        if self.acc >= PROGRESS_FLUSH_BYTES:
+            self.advance(advance=self.acc)
+            self.acc = 0
+    
+    def flush(self):
+        if self.acc:
+            self.advance(advance=self.acc)
+            self.acc = 0
+
+
+# Tampon de réception réutilisé par thread (recv_into : pas de bytes alloué par bloc)
+_recv_buffers = threading.local()
+
+
+def _splice_to_file(conn, fileno, sink):
+    """Copie le canal de données vers le fichier via un pipe, sans passer par l'espace utilisateur"""
+    r, w = os.pipe()
+    try:
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, TRANSFER_BLOCKSIZE)
+            except OSError:
+                pass
+        sock_fd = conn.fileno()
+        timeout = conn.gettimeout()
+        # Boucle chaude : fonctions et constantes en variables locales
+        splice = os.splice
+        flags = os.SPLICE_F_MOVE
+        count = sink.count
+        while True:
+            try:
+                n = splice(sock_fd, w, TRANSFER_BLOCKSIZE, flags=flags)
+            except BlockingIOError:
+                # Socket avec timeout (non bloquant côté OS) : attendre les données
+                if not select.select([sock_fd], [], [], timeout)[0]:
+                    raise TimeoutError("Data connection timed out")
+                continue
+            if not n:
+                break
+            while n:
+                moved = splice(r, fileno, n, flags=flags)
+                n -= moved
+                count(moved)
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def _retr_into(ftp, remote_file_path, sink, fileno=None):
+    """
+    RETR binaire équivalent à retrbinary, mais en recv_into dans un tampon
+    réutilisé ; le sink reçoit des memoryview. Avec fileno (gros fichiers,
+    Linux, FTP en clair), les données sont copiées par splice() directement
+    dans le fichier. SFTPAdapter n'ayant pas de canal de données, il passe
+    par son propre retrbinary.
+    """
+    if not hasattr(ftp, 'transfercmd'):
+        return ftp.retrbinary(f"RETR {remote_file_path}", sink, blocksize=TRANSFER_BLOCKSIZE)
+    
+    view = getattr(_recv_buffers, 'view', None)
+    if view is None:
+        view = _recv_buffers.view = memoryview(bytearray(TRANSFER_BLOCKSIZE))
+    
+    ftp.voidcmd('TYPE I')
+    conn = ftp.transfercmd(f"RETR {remote_file_path}")
+    try:
+        with conn:
+            if fileno is not None and HAS_SPLICE and not hasattr(conn, 'unwrap'):
+                _splice_to_file(conn, fileno, sink)
+            else:
+                recv_into = conn.recv_into
+                while True:
+                    n = recv_into(view)
+                    if not n:
+                        break
+                    sink(view[:n])
+            if hasattr(conn, 'unwrap'):  # FTP_TLS : fermeture propre de la session SSL
+                conn.unwrap()
+    except Exception:
+        # Resynchroniser le canal de contrôle avant un éventuel nouvel essai
+        try:
+            ftp.abort()
+        except Exception:
+            pass
+        raise
+    return ftp.voidresp()
+
 
 class BackupMixin:
+    @staticmethod
+    def _try_remove(path):
+        """Supprime un fichier : 1 si supprimé, 0 si déjà absent, sinon l'exception"""
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            return e
+
     def handle_deleted_files(self, local_path, deleted_files):
         """
         Supprime automatiquement les fichiers locaux qui ont été
@@ -17,15 +166,18 @@ class BackupMixin:
 
         deleted_count = 0
         failed_count = 0
-        for rel_path in deleted_files:
-            local_file = os.path.join(local_path, rel_path)
-            if os.path.exists(local_file):
-                try:
-                    os.remove(local_file)
+        # Suppressions en parallèle : sur un partage réseau chaque unlink coûte un aller-retour
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = executor.map(
+                self._try_remove,
+                (os.path.join(local_path, rel_path) for rel_path in deleted_files)
+            )
+            for rel_path, result in zip(deleted_files, results):
+                if result == 1:
                     deleted_count += 1
-                except Exception as e:
+                elif isinstance(result, Exception):
                     failed_count += 1
-                    console.print(f"[red]Failed to delete {rel_path}: {e}[/red]")
+                    console.print(f"[red]Failed to delete {rel_path}: {result}[/red]")
 
         console.print(f"[green]✅ Deleted {deleted_count:,} files locally.[/green]")
         if failed_count > 0:
@@ -43,21 +195,26 @@ class BackupMixin:
                 'parallel_downloads': 0,
             }
         
-        remote_path = os.path.join(self.remote_base, remote_project_name).replace('\\', '/')
+        remote_path = posixpath.join(self.remote_base, remote_project_name)
         state_file = f"state_backup_{remote_project_name.replace('/', '_')}.json"
         
-        current_state = self.load_state(state_file)
-        new_state = {}
+        state_manager = self.open_state_db(state_file)
         
-        if not os.path.exists(local_path):
-            os.makedirs(local_path)
+        os.makedirs(local_path, exist_ok=True)
 
         with self.connect() as ftp:
             console.print(f"[cyan]Connecting to {self.ftp_host}...[/cyan]")
             
             # Scan remote
+            # Cache des listings : les dossiers dont la date n'a pas changé ne sont pas re-listés
+            dir_states = state_manager.get_directory_states() if options.get('cache_dir_listings') else None
+            
             with console.status(f"[bold cyan]Scanning remote: {remote_path}...") as status:
-                remote_files = self.get_remote_files(ftp, remote_path, status=status)
+                remote_files = self.get_remote_files(
+                    ftp, remote_path, status=status,
+                    state_manager=state_manager, dir_states=dir_states,
+                    exclude=self.should_exclude if options.get('exclude_patterns') else None
+                )
             
             if not remote_files:
                 console.print(f"[bold red]No files found in remote project: {remote_path}[/bold red]")
@@ -65,46 +222,26 @@ class BackupMixin:
             
             # Appliquer les exclusions
             if options.get('exclude_patterns'):
-                original_count = len(remote_files)
-                remote_files = {
-                    k: v for k, v in remote_files.items() 
-                    if not self.should_exclude(k)
-                }
-                excluded_count = original_count - len(remote_files)
+                excluded_count = self.remove_excluded(remote_files)
                 if excluded_count > 0:
                     console.print(f"[yellow]📦 Excluded {excluded_count} files (logs, cache, tmp, etc.)[/yellow]")
             
             console.print(f"[green]✅ Found {len(remote_files)} files to backup.[/green]")
             
-            # Calculer les fichiers à télécharger
-            files_to_download = []
-            total_bytes = 0
-            
-            for rel_path, info in remote_files.items():
-                needs_download = rel_path not in current_state or \
-                                current_state[rel_path]['size'] != info['size'] or \
-                                current_state[rel_path]['modify'] != info['modify']
-                if needs_download:
-                    files_to_download.append((rel_path, info['size']))
-                    total_bytes += info['size']
-                new_state[rel_path] = info
+            # Calculer les fichiers à télécharger (comparaison indexée en base)
+            files_to_download, total_bytes, deleted_files = state_manager.find_files_to_download(remote_files)
             
             # Gérer les fichiers supprimés
-            if options.get('handle_deletions'):
-                local_files_in_state = set(current_state.keys())
-                remote_files_set = set(remote_files.keys())
-                deleted_files = local_files_in_state - remote_files_set
-                
-                if deleted_files:
+            if deleted_files:
+                if options.get('handle_deletions'):
                     self.handle_deleted_files(local_path, deleted_files)
-                    # Mettre à jour le state pour retirer les fichiers supprimés
-                    for deleted_file in deleted_files:
-                        if deleted_file in current_state:
-                            del current_state[deleted_file]
+                # Retirer du state les fichiers disparus du serveur
+                state_manager.delete_files(deleted_files)
             
             if not files_to_download:
                 console.print("[bold green]✅ Local backup is up-to-date. No files to download.[/bold green]")
-                self.save_state(state_file, new_state)
+                if dir_states is not None:
+                    state_manager.save_directory_states(dir_states)
                 return
             
             console.print(f"\n[bold cyan]🚀 Starting backup of {len(files_to_download)} files ({total_bytes/1024/1024:.2f} MB)...[/bold cyan]\n")
@@ -115,7 +252,12 @@ class BackupMixin:
                 local_path, total_bytes, options
             )
         
-        self.save_state(state_file, new_state)
+        # Seules les lignes des fichiers nouveaux/modifiés sont réécrites
+        state_manager.update_file_batch({
+            rel_path: remote_files[rel_path] for rel_path, size in files_to_download
+        })
+        if dir_states is not None:
+            state_manager.save_directory_states(dir_states)
         
         # Résumé final
         console.print("\n" + "="*70)
@@ -123,7 +265,7 @@ class BackupMixin:
         summary_table.add_column("Metric", style="cyan")
         summary_table.add_column("Value", style="green", justify="right")
         
-        summary_table.add_row("Total Files", str(len(new_state)))
+        summary_table.add_row("Total Files", str(len(remote_files)))
         summary_table.add_row("Files Downloaded", f"[green]{success_count}[/green]")
         if failed_count > 0:
             summary_table.add_row("Files Failed", f"[red]{failed_count}[/red]")
@@ -141,8 +283,65 @@ class BackupMixin:
         else:
             console.print(f"[bold yellow]⚠️  Backup completed with issues. Check logs for details.[/bold yellow]\n")
     
+    def _tar_stream_download(self, ftp, files_to_download, remote_path, local_path):
+        """
+        SFTP : télécharge les fichiers par un flux tar unique sur SSH (un seul
+        canal au lieu d'un aller-retour par fichier).
+        Retourne (nombre de fichiers extraits et vérifiés, fichiers à reprendre un par un).
+        """
+        from modules.tar_downloader import TarStreamDownloader
+        
+        try:
+            tar_dl = TarStreamDownloader(ftp.ssh, remote_path, local_path, sftp_client=ftp.sftp)
+            if not tar_dl.is_available():
+                return 0, files_to_download
+            
+            console.print(f"[dim]   Tar stream ({len(files_to_download):,} files)...[/dim]")
+            with Progress(
+                SpinnerColumn(),
+                TextColumn("[progress.description]{task.description}"),
+                BarColumn(),
+                TextColumn("{task.completed}/{task.total} files"),
+                console=console
+            ) as progress:
+                task = progress.add_task("[cyan]Tar streaming...", total=len(files_to_download))
+                tar_dl.download_files(
+                    [rel_path for rel_path, size in files_to_download],
+                    lambda completed, total, stats: progress.update(task, completed=completed),
+                    use_compression=True, sftp_client=ftp.sftp
+                )
+        except Exception as e:
+            console.print(f"[yellow]⚠️  Tar stream failed, falling back to per-file transfers: {e}[/yellow]")
+            return 0, files_to_download
+        
+        # Tout fichier absent ou de taille inattendue repasse par le transfert unitaire
+        failed = set(tar_dl.verify_extraction(dict(files_to_download)))
+        remaining = [(rel_path, size) for rel_path, size in files_to_download if rel_path in failed]
+        return len(files_to_download) - len(remaining), remaining
+    
     def _download_files(self, ftp, files_to_download, remote_path, local_path, total_bytes, options):
         """Download files avec retry et vérification d'intégrité"""
+        num_workers = options.get('parallel_downloads') or 0
+        counts = Counter()  # 'success' / 'failed' / 'corrupted', seul point de comptage
+        
+        if getattr(ftp, 'ssh', None) and len(files_to_download) >= TAR_STREAM_THRESHOLD:
+            counts['success'], files_to_download = self._tar_stream_download(
+                ftp, files_to_download, remote_path, local_path
+            )
+            if not files_to_download:
+                return counts['success'], counts['failed'], counts['corrupted']
+            total_bytes = sum(size for rel_path, size in files_to_download)
+        
+        # Préfixes calculés une fois : chemins par concaténation dans la boucle
+        remote_prefix = remote_path.rstrip('/') + '/'
+        local_prefix = os.path.join(local_path, '')
+        
+        # Dossiers locaux créés une seule fois, avant de lancer les workers
+        # (_download_one ne fait plus qu'un test d'appartenance par fichier)
+        self._created_local_dirs = set()
+        for local_dir in {os.path.dirname(local_prefix + rel_path) for rel_path, _ in files_to_download}:
+            os.makedirs(local_dir, exist_ok=True)
+            self._created_local_dirs.add(local_dir)
         
         with Progress(
             SpinnerColumn(),
@@ -151,74 +350,153 @@ class BackupMixin:
             TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
             TransferSpeedColumn(),
             TimeRemainingColumn(),
-            console=console
+            console=console,
+            refresh_per_second=4  # rendu allégé : la progression arrive déjà par paquets de 1 MiB
         ) as progress:
             overall_task = progress.add_task("[blue]Downloading...", total=total_bytes)
             
-            success_count = 0
-            failed_count = 0
-            corrupted_count = 0
-            
-            for rel_path, size in files_to_download:
-                progress.update(overall_task, description=f"[blue]Downloading {rel_path}...")
+            if num_workers > 1:
+                # Pool de connexions : une session FTP ne supporte qu'un seul
+                # transfert à la fois, chaque worker emprunte donc sa propre connexion
+                # La connexion du scan, déjà authentifiée, sert de premier slot
+                pool = queue.Queue()
+                pool.put(ftp)
+                for _ in range(num_workers - 1):
+                    pool.put(None)  # connexion ouverte au premier emprunt
                 
-                local_file_path = os.path.join(local_path, rel_path)
-                remote_file_path = os.path.join(remote_path, rel_path).replace('\\', '/')
+                @contextmanager
+                def checkout():
+                    slot = [pool.get()]
+                    try:
+                        if slot[0] is None:
+                            slot[0] = self.connect()
+                        yield slot
+                    finally:
+                        # Remet la connexion (éventuellement remplacée après reconnexion)
+                        pool.put(slot[0])
                 
-                os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
+                def worker(rel_path, size):
+                    with checkout() as slot:
+                        outcome, slot[0] = self._download_one(
+                            slot[0], rel_path, size, remote_prefix, local_prefix,
+                            options, progress, overall_task
+                        )
+                    return outcome
                 
-                # Retry logic (3 tentatives)
-                download_success = False
-                for attempt in range(3):
-                    try:
-                        # Vérifier connexion
-                        if attempt > 0:
+                try:
+                    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                        futures = {
+                            executor.submit(worker, rel_path, size): rel_path
+                            for rel_path, size in files_to_download
+                        }
+                        for future in as_completed(futures):
                             try:
-                                ftp.voidcmd('NOOP')
-                            except:
-                                progress.console.log("[yellow]Connection lost. Reconnecting...[/yellow]")
-                                ftp = self.connect()
-                        
-                        # Download
-                        with open(local_file_path, 'wb') as f:
-                            ftp.retrbinary(
-                                f"RETR {remote_file_path}", 
-                                lambda data: (f.write(data), progress.update(overall_task, advance=len(data)))[0]
-                            )
-                        
-                        # Vérification d'intégrité
-                        if options.get('verify_integrity'):
-                            is_valid, msg = self.verify_file_integrity(local_file_path, size)
-                            if not is_valid:
-                                progress.console.log(f"[yellow]⚠️  Integrity check failed for {rel_path}: {msg}[/yellow]")
-                                
-                                # Si c'est la dernière tentative
-                                if attempt == 2:
-                                    os.remove(local_file_path)
-                                    corrupted_count += 1
-                                    progress.console.log(f"[red]❌ File corrupted after 3 attempts: {rel_path}[/red]")
-                                    break
-                                else:
-                                    # Réessayer
-                                    progress.console.log(f"[yellow]Retrying download (attempt {attempt+2}/3)...[/yellow]")
-                                    os.remove(local_file_path)
-                                    continue
-                        
-                        # Succès
-                        success_count += 1
-                        download_success = True
-                        break
-                        
-                    except Exception as e:
-                        progress.console.log(f"[yellow]Attempt {attempt+1}/3 failed for {rel_path}: {e}[/yellow]")
+                                counts[future.result()] += 1
+                            except Exception as e:
+                                # Connexion impossible pour ce worker
+                                counts['failed'] += 1
+                                progress.console.log(f"[red]❌ Failed: {futures[future]} - {e}[/red]")
+                finally:
+                    while not pool.empty():
+                        conn = pool.get_nowait()
+                        if conn is None or conn is ftp:
+                            continue  # ftp est fermée par l'appelant
+                        try:
+                            conn.quit()
+                        except Exception:
+                            try:
+                                conn.close()
+                            except Exception:
+                                pass
+            else:
+                download_one = self._download_one
+                for rel_path, size in files_to_download:
+                    outcome, ftp = download_one(
+                        ftp, rel_path, size, remote_prefix, local_prefix,
+                        options, progress, overall_task
+                    )
+                    counts[outcome] += 1
+            
+            return counts['success'], counts['failed'], counts['corrupted']
+    
+    def _download_one(self, ftp, rel_path, size, remote_prefix, local_prefix, options, progress, overall_task):
+        """
+        Télécharge un fichier (3 tentatives) et vérifie son intégrité.
+        Retourne (outcome, ftp) : outcome vaut 'success', 'failed' ou 'corrupted',
+        ftp est la connexion à réutiliser (remplacée en cas de reconnexion).
+        """
+        progress.update(overall_task, description=f"[blue]Downloading {rel_path}...")
+        
+        local_file_path = local_prefix + rel_path
+        remote_file_path = remote_prefix + rel_path
+        
+        local_dir = os.path.dirname(local_file_path)
+        if local_dir not in self._created_local_dirs:
+            os.makedirs(local_dir, exist_ok=True)
+            self._created_local_dirs.add(local_dir)
+        
+        # Retry logic (3 tentatives)
+        for attempt in range(3):
+            try:
+                # Vérifier connexion
+                if attempt > 0:
+                    try:
+                        ftp.voidcmd('NOOP')
+                    except:
+                        progress.console.log("[yellow]Connection lost. Reconnecting...[/yellow]")
+                        ftp = self.connect()
+                
+                # Download
+                with open(local_file_path, 'wb', buffering=TRANSFER_BLOCKSIZE) as f:
+                    # Gros fichiers : réserver les extents d'un coup (moins de fragmentation)
+                    preallocated = False
+                    if size >= PREALLOCATE_MIN_BYTES and hasattr(os, 'posix_fallocate'):
+                        try:
+                            os.posix_fallocate(f.fileno(), 0, size)
+                            preallocated = True
+                        except OSError:
+                            pass
+                    
+                    sink = _ChunkSink(f, progress, overall_task)
+                    # Gros fichiers : splice() si disponible (rien n'est encore bufferisé dans f)
+                    fileno = f.fileno() if size >= SPLICE_MIN_BYTES else None
+                    _retr_into(ftp, remote_file_path, sink, fileno)
+                    sink.flush()
+                    
+                    # Ramener le fichier à la taille réellement reçue
+                    if preallocated:
+                        f.truncate()
+                
+                # Vérification d'intégrité
+                if options.get('verify_integrity'):
+                    # Taille comptée en vol : pas de stat du fichier écrit
+                    is_valid, msg = self.verify_file_integrity_streaming(sink.received, size)
+                    if not is_valid:
+                        progress.console.log(f"[yellow]⚠️  Integrity check failed for {rel_path}: {msg}[/yellow]")
                         
+                        # Si c'est la dernière tentative
                         if attempt == 2:
-                            # Dernière tentative échouée
-                            progress.console.log(f"[red]❌ Failed permanently: {rel_path}[/red]")
-                            failed_count += 1
-                            
-                            # Supprimer fichier partiel si existe
-                            if os.path.exists(local_file_path):
-                                os.remove(local_file_path)
-            
-            return success_count, failed_count, corrupted_count
+                            os.remove(local_file_path)
+                            progress.console.log(f"[red]❌ File corrupted after 3 attempts: {rel_path}[/red]")
+                            return 'corrupted', ftp
+                        else:
+                            # Réessayer
+                            progress.console.log(f"[yellow]Retrying download (attempt {attempt+2}/3)...[/yellow]")
+                            os.remove(local_file_path)
+                            continue
+                
+                # Succès
+                return 'success', ftp
+                
+            except Exception as e:
+                progress.console.log(f"[yellow]Attempt {attempt+1}/3 failed for {rel_path}: {e}[/yellow]")
+                
+                if attempt == 2:
+                    # Dernière tentative échouée
+                    progress.console.log(f"[red]❌ Failed permanently: {rel_path}[/red]")
+                    
+                    # Supprimer fichier partiel si existe
+                    if os.path.exists(local_file_path):
+                        os.remove(local_file_path)
+        
+        return 'failed', ftp
@@ -4,35 +4,44 @@ Utilise tous les composants optimisés pour gérer 1M+ fichiers
 """
 
 import os
+import posixpath
 import uuid
+from bisect import bisect_left
+from itertools import chain
 from datetime import datetime
 from rich.table import Table
 from rich.panel import Panel
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeRemainingColumn
 from rich import box
 
-from modules.core import console
-from modules.state_manager import StateManager
+from modules.core import console, make_exclude_filter
+from modules.state_manager import StateManager, iter_chunks, iter_json_state, remove_database
 from modules.parallel_downloader import ParallelDownloader, DownloadTask, DownloadOrganizer
 from modules.incremental_scanner import IncrementalScanner
 
 def migrate_json_to_sqlite(json_file: str, db_file: str):
     """Imported/Refactored from migrate_state.py for auto-migration"""
-    import json
     try:
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-        if not data:
-            return
-        
-        state_manager = StateManager(db_file)
-        # Migrer par batch
-        batch_size = 1000
-        items = list(data.items())
-        
-        for i in range(0, len(items), batch_size):
-            batch = dict(items[i:i+batch_size])
-            state_manager.update_file_batch(batch, batch_size=batch_size)
+        with open(json_file, 'rb') as f:
+            entries = iter_json_state(f)
+            first = next(entries, None)
+            if first is None:
+                return
+            
+            # Base neuve : chargement sans journal (le JSON reste la source en cas d'échec)
+            fresh = not os.path.exists(db_file)
+            state_manager = StateManager(db_file)
+            # Migrer par batch (lecture en flux, une seule transaction)
+            batch_size = 1000
+            try:
+                with state_manager.transaction(bulk=fresh):
+                    for batch in iter_chunks(chain([first], entries), batch_size):
+                        state_manager.update_file_batch_iter(batch, batch_size=batch_size)
+            except BaseException:
+                if fresh:
+                    remove_database(db_file)
+                raise
+            state_manager.optimize()
         
         # Renommer l'ancien fichier JSON
         backup_name = json_file + ".migrated_backup"
@@ -74,7 +83,7 @@ class BackupOptimizedMixin:
                          f"(SSH connections are heavier than FTP)[/yellow]")
             options['num_workers'] = SFTP_MAX_WORKERS
         
-        remote_path = os.path.join(self.remote_base, remote_project_name).replace('\\', '/')
+        remote_path = posixpath.join(self.remote_base, remote_project_name)
         
         # Gérer la migration automatique
         state_json_path = f"state_backup_{remote_project_name.replace('/', '_')}.json"
@@ -92,8 +101,7 @@ class BackupOptimizedMixin:
         # ID unique pour cette synchronisation
         sync_id = str(uuid.uuid4())
         
-        if not os.path.exists(local_path):
-            os.makedirs(local_path)
+        os.makedirs(local_path, exist_ok=True)
         
         console.print("\n" + "="*70)
         console.print(Panel.fit(
@@ -110,10 +118,12 @@ class BackupOptimizedMixin:
         # PHASE 1: SCAN REMOTE avec scan incrémental
         console.print("[bold cyan]📡 PHASE 1: Scanning remote server...[/bold cyan]")
         
+        remote_count = excluded_count = 0
+        is_excluded = make_exclude_filter(self.EXCLUDE_PATTERNS) if options.get('exclude_patterns') else None
         with self.connect() as ftp:
             if options.get('use_incremental_scan'):
                 # Scan incrémental (beaucoup plus rapide)
-                cache_file = f".scan_cache_{remote_project_name.replace('/', '_')}.pkl"
+                cache_file = f".scan_cache_{remote_project_name.replace('/', '_')}.bin"
 
                 # Reconnect factory for scanner — creates a fresh connection
                 def scanner_reconnect():
@@ -127,15 +137,18 @@ class BackupOptimizedMixin:
                     reconnect_factory=scanner_reconnect
                 )
                 
-                def scan_status_callback(stats):
-                    if stats.get('strategy') == 'ssh_find':
-                        console.print(f"[dim]SSH find: found {stats['files_found']:,} files so far...[/dim]")
-                    else:
-                        console.print(f"[dim]Scanned {stats['dirs_scanned']} dirs, "
-                                    f"found {stats['files_found']} files "
-                                    f"(cache hits: {stats['cache_hits']})[/dim]")
-                
-                remote_files = scanner.scan_smart(status_callback=scan_status_callback)
+                # Progression du scan sur une seule ligne (spinner) : un console.print
+                # tous les 10 dossiers / 5000 fichiers faisait défiler des milliers de lignes
+                with console.status("[bold cyan]Scanning remote...") as status:
+                    def scan_status_callback(stats):
+                        if stats.get('strategy') == 'ssh_find':
+                            status.update(f"[bold cyan]SSH find: found {stats['files_found']:,} files so far...")
+                        else:
+                            status.update(f"[bold cyan]Scanned {stats['dirs_scanned']:,} dirs, "
+                                          f"found {stats['files_found']:,} files "
+                                          f"(cache hits: {stats['cache_hits']:,})")
+                    
+                    remote_files = scanner.scan_smart(status_callback=scan_status_callback)
                 scan_stats = scanner.get_statistics()
                 
                 console.print(f"[green]✅ Scan completed using [bold]{scan_stats['strategy']}[/bold] strategy[/green]")
@@ -146,34 +159,50 @@ class BackupOptimizedMixin:
                 if scan_stats.get('scan_errors', 0) > 0:
                     console.print(f"[yellow]   Directories skipped (errors): {scan_stats['scan_errors']}[/yellow]")
                 console.print()
+                
+                # Exclusions appliquées pendant le chargement dans remote_scan : une
+                # seule passe, le dict (cache du scanner) n'est ni filtré ni copié
+                with console.status("[bold cyan]Loading scan into database..."):
+                    remote_count = state_manager.load_remote_scan(remote_files, exclude=is_excluded)
+                excluded_count = len(remote_files) - remote_count
+                del remote_files, scanner
             else:
-                # Scan complet classique
+                # Scan complet classique : les entrées vont directement dans
+                # remote_scan au fil du listing, sans dict du scan en mémoire
                 with console.status("[bold cyan]Scanning (full mode)...") as status:
-                    remote_files = self.get_remote_files(ftp, remote_path, status=status)
+                    entries = self.iter_remote_files(
+                        ftp, remote_path, status=status,
+                        exclude=self.should_exclude if is_excluded else None
+                    )
+                    if is_excluded:
+                        def kept(entries):
+                            nonlocal excluded_count
+                            for entry in entries:
+                                if is_excluded(entry[0]):
+                                    excluded_count += 1
+                                else:
+                                    yield entry
+                        
+                        entries = kept(entries)
+                    remote_count = state_manager.load_remote_scan(entries)
                 console.print(f"[green]✅ Full scan completed[/green]\n")
         
-        if not remote_files:
+        if not remote_count and not excluded_count:
             console.print(f"[bold red]❌ No files found in: {remote_path}[/bold red]\n")
             return
         
-        # Appliquer les exclusions
-        if options.get('exclude_patterns'):
-            original_count = len(remote_files)
-            remote_files = {
-                k: v for k, v in remote_files.items() 
-                if not self.should_exclude(k)
-            }
-            excluded_count = original_count - len(remote_files)
-            if excluded_count > 0:
-                console.print(f"[yellow]📦 Excluded {excluded_count:,} files (logs, cache, tmp)[/yellow]\n")
+        if excluded_count > 0:
+            console.print(f"[yellow]📦 Excluded {excluded_count:,} files (logs, cache, tmp)[/yellow]\n")
         
-        console.print(f"[bold green]✅ Found {len(remote_files):,} files to process[/bold green]\n")
+        console.print(f"[bold green]✅ Found {remote_count:,} files to process[/bold green]\n")
         
         # PHASE 2 & 3: COMPARISON + DELETIONS (memory-efficient via SQLite)
         console.print("[bold cyan]🔍 PHASE 2: Comparing with local state...[/bold cyan]")
 
         with console.status("[bold cyan]Comparing against database..."):
-            files_to_download, total_bytes, deleted_files = state_manager.find_files_to_download(remote_files)
+            # Le scan est dans la base (remote_scan) : comparaison et mise à
+            # jour finale se font en SQL
+            files_to_download, total_bytes, deleted_files = state_manager.find_files_to_download_scan()
 
         db_stats = state_manager.get_statistics()
         console.print(f"[dim]   State database: {db_stats['total_files']:,} files cached[/dim]")
@@ -185,8 +214,8 @@ class BackupOptimizedMixin:
             console.print(f"[yellow]⚠️  {len(deleted_files):,} files were deleted on remote server[/yellow]")
             self.handle_deleted_files(local_path, deleted_files)
 
-            # Supprimer du state
-            state_manager.delete_files(list(deleted_files))
+            # Supprimer du state (anti-jointure avec le scan, en base)
+            state_manager.delete_missing_from_scan()
             console.print()
         
         # PHASE 4: DOWNLOAD PARALLÈLE
@@ -196,7 +225,7 @@ class BackupOptimizedMixin:
             # Sauvegarder le state quand meme
             console.print("[bold cyan]💾 Updating state database...[/bold cyan]")
             with console.status("[bold cyan]Saving state..."):
-                state_manager.update_file_batch(remote_files, batch_size=5000)
+                state_manager.commit_remote_scan()
             console.print(f"[green]✅ State database updated[/green]\n")
 
             # Statistiques finales
@@ -206,11 +235,19 @@ class BackupOptimizedMixin:
         console.print(f"[bold cyan]⬇️  PHASE 4: Downloading {len(files_to_download):,} files "
                      f"({total_bytes/1024/1024:.2f} MB)[/bold cyan]\n")
 
+        # WAL reporté une fois avant les téléchargements : les checkpoints de
+        # progression ne sont ensuite que de petits INSERT
+        state_manager.wal_checkpoint('FULL')
+
         start_time = datetime.now()
         success_count = 0
         failed_count = 0
         tar_download_done = False
 
+        # Préfixes calculés une fois (rel_path est déjà en POSIX depuis le scan)
+        remote_prefix = remote_path.rstrip('/') + '/'
+        local_prefix = os.path.join(local_path, '')
+
         # ── RSYNC (best option when available) ──
         rsync_done = False
         if self.ftp_port == 22 and len(files_to_download) >= 10:
@@ -239,7 +276,7 @@ class BackupOptimizedMixin:
                     # Full tar downloads the entire directory — best when we need
                     # most of the files anyway.  Selective tar passes files as
                     # command-line arguments (batched to stay under ARG_MAX).
-                    use_full_tar = len(files_to_download) >= len(remote_files) * 0.5
+                    use_full_tar = len(files_to_download) >= remote_count * 0.5
 
                     with Progress(
                         SpinnerColumn(),
@@ -266,7 +303,7 @@ class BackupOptimizedMixin:
 
                         if use_full_tar:
                             console.print(f"[dim]   Full directory tar "
-                                        f"({len(files_to_download):,}/{len(remote_files):,} files)...[/dim]")
+                                        f"({len(files_to_download):,}/{remote_count:,} files)...[/dim]")
                             tar_stats = tar_dl.download_all(
                                 tar_progress, use_compression=True,
                                 expected_total=len(files_to_download)
@@ -285,24 +322,29 @@ class BackupOptimizedMixin:
                     # Verify integrity
                     if options.get('verify_integrity'):
                         console.print("[dim]   Verifying extracted files...[/dim]")
-                        expected = {rp: sz for rp, sz in files_to_download}
-                        verify_failed = tar_dl.verify_extraction(expected)
+                        verify_failed = tar_dl.verify_extraction(files_to_download)
                         if verify_failed:
                             failed_files = verify_failed
                             success_count = len(files_to_download) - len(verify_failed)
                             console.print(f"[yellow]   {len(verify_failed)} files need retry via SFTP...[/yellow]")
 
-                    ftp_conn.close()
-
                     # Retry failed files with per-file SFTP
+                    # (canaux ouverts sur la connexion SSH du tar : pas de nouvelle poignée de main)
                     if failed_files:
-                        size_lookup = dict(files_to_download)
+                        # files_to_download est trié par rel_path : tailles retrouvées
+                        # par bisect, sans dict de toute la liste pour quelques échecs
+                        def expected_size(rp):
+                            i = bisect_left(files_to_download, (rp,))
+                            if i < len(files_to_download) and files_to_download[i][0] == rp:
+                                return files_to_download[i][1]
+                            return 0
+
                         retry_tasks = [
                             DownloadTask(
                                 rel_path=rp,
-                                remote_path=os.path.join(remote_path, rp).replace('\\', '/'),
-                                local_path=os.path.join(local_path, rp),
-                                size=size_lookup.get(rp, 0),
+                                remote_path=remote_prefix + rp,
+                                local_path=local_prefix + rp,
+                                size=expected_size(rp),
                                 priority=0
                             )
                             for rp in failed_files
@@ -316,24 +358,23 @@ class BackupOptimizedMixin:
                             ftp_pass=self.ftp_pass,
                             num_workers=min(3, options['num_workers']),
                             max_retries=3,
-                            verify_integrity=options.get('verify_integrity', True)
+                            verify_integrity=options.get('verify_integrity', True),
+                            use_hash_verification=options.get('hash_verification', False),
+                            shared_ssh=ftp_conn
                         )
                         retry_dl.add_tasks(retry_tasks)
                         retry_dl.start()
                         retry_dl.wait_completion()
                         retry_dl.stop()
 
-                        for result in retry_dl.collect_results():
-                            if result.success:
-                                success_count += 1
-                            else:
-                                state_manager.log_error(
-                                    sync_id=sync_id,
-                                    rel_path=result.rel_path,
-                                    error_message=result.error_message or "Unknown error",
-                                    retry_count=result.retry_count
-                                )
+                        retry_results = retry_dl.collect_results()
+                        success_count += sum(1 for r in retry_results if r.success)
+                        state_manager.log_errors_batch(
+                            (sync_id, r.rel_path, r.error_message or "Unknown error", r.retry_count)
+                            for r in retry_results if not r.success
+                        )
 
+                    ftp_conn.close()
                     failed_count = len(files_to_download) - success_count
                     tar_download_done = True
 
@@ -348,22 +389,19 @@ class BackupOptimizedMixin:
 
         # ── PER-FILE PARALLEL DOWNLOAD (fallback / default for FTP) ──
         if not tar_download_done:
-            download_tasks = []
-            for rel_path, size in files_to_download:
-                remote_file_path = os.path.join(remote_path, rel_path).replace('\\', '/')
-                local_file_path = os.path.join(local_path, rel_path)
-
-                task = DownloadTask(
-                    rel_path=rel_path,
-                    remote_path=remote_file_path,
-                    local_path=local_file_path,
-                    size=size,
-                    priority=0
-                )
-                download_tasks.append(task)
-
             console.print("[dim]   Organizing downloads with hybrid strategy...[/dim]")
-            download_tasks = DownloadOrganizer.prioritize_hybrid(download_tasks)
+            # Ordre calculé sur les colonnes (chemins, tailles) ; les DownloadTask
+            # ne sont créées qu'une fois, directement dans l'ordre final
+            rel_paths = [rel_path for rel_path, size in files_to_download]
+            sizes = [size for rel_path, size in files_to_download]
+            order = DownloadOrganizer.hybrid_order(rel_paths, sizes)
+
+            download_tasks = [
+                DownloadTask(rel_paths[idx], remote_prefix + rel_paths[idx],
+                             local_prefix + rel_paths[idx], sizes[idx], priority)
+                for priority, idx in enumerate(order)
+            ]
+            del rel_paths, sizes, order
 
             downloader = ParallelDownloader(
                 ftp_host=self.ftp_host,
@@ -372,7 +410,8 @@ class BackupOptimizedMixin:
                 ftp_pass=self.ftp_pass,
                 num_workers=options['num_workers'],
                 max_retries=3,
-                verify_integrity=options.get('verify_integrity', True)
+                verify_integrity=options.get('verify_integrity', True),
+                use_hash_verification=options.get('hash_verification', False)
             )
 
             downloader.add_tasks(download_tasks)
@@ -381,7 +420,9 @@ class BackupOptimizedMixin:
             last_checkpoint = 0
             checkpoint_interval = options.get('checkpoint_interval', 1000)
 
-            with Progress(
+            # Checkpoints écrits en arrière-plan : la boucle de progression ne
+            # bloque pas sur SQLite ; tout est écrit à la sortie du with
+            with state_manager.checkpoint_writer() as checkpoints, Progress(
                 SpinnerColumn(),
                 TextColumn("[progress.description]{task.description}"),
                 BarColumn(),
@@ -412,7 +453,7 @@ class BackupOptimizedMixin:
                     )
 
                     if completed - last_checkpoint >= checkpoint_interval:
-                        state_manager.create_checkpoint(
+                        checkpoints.put(
                             sync_id=sync_id,
                             files_processed=completed,
                             files_total=total,
@@ -430,14 +471,11 @@ class BackupOptimizedMixin:
             success_count = sum(1 for r in results if r.success)
             failed_count = sum(1 for r in results if not r.success)
 
-            for result in results:
-                if not result.success:
-                    state_manager.log_error(
-                        sync_id=sync_id,
-                        rel_path=result.rel_path,
-                        error_message=result.error_message or "Unknown error",
-                        retry_count=result.retry_count
-                    )
+            # Erreurs enregistrées en un seul executemany
+            state_manager.log_errors_batch(
+                (sync_id, r.rel_path, r.error_message or "Unknown error", r.retry_count)
+                for r in results if not r.success
+            )
 
             console.print(f"\n[green]✅ Download phase completed[/green]")
             console.print(f"[dim]   Success: {success_count:,} | Failed: {failed_count:,}[/dim]\n")
@@ -445,20 +483,24 @@ class BackupOptimizedMixin:
         # PHASE 5: UPDATE STATE DATABASE
         console.print("[bold cyan]💾 PHASE 5: Updating state database...[/bold cyan]")
         
-        with console.status("[bold cyan]Saving state..."):
-            state_manager.update_file_batch(remote_files, batch_size=5000)
+        # État + checkpoint final : une seule transaction (un seul fsync)
+        with console.status("[bold cyan]Saving state..."), state_manager.transaction():
+            state_manager.commit_remote_scan()
+            
+            # Checkpoint final
+            state_manager.create_checkpoint(
+                sync_id=sync_id,
+                files_processed=len(files_to_download),
+                files_total=len(files_to_download),
+                bytes_transferred=total_bytes,
+                status='completed' if failed_count == 0 else 'completed_with_errors'
+            )
         
+        # WAL vidé et tronqué une fois l'état final écrit
+        state_manager.wal_checkpoint('TRUNCATE')
+        state_manager.optimize()
         console.print(f"[green]✅ State database updated[/green]\n")
         
-        # Checkpoint final
-        state_manager.create_checkpoint(
-            sync_id=sync_id,
-            files_processed=len(files_to_download),
-            files_total=len(files_to_download),
-            bytes_transferred=total_bytes,
-            status='completed' if failed_count == 0 else 'completed_with_errors'
-        )
-        
         # SUMMARY
         self._show_backup_summary(
             state_manager, sync_id, 
@@ -524,8 +566,10 @@ class BackupOptimizedMixin:
                 success = 0
                 vanished = 0
                 real_failed = 0
+                not_transferred = []
+                local_prefix = os.path.join(local_path, '')
                 for rel_path, size in files_to_download:
-                    local_file = os.path.join(local_path, rel_path)
+                    local_file = local_prefix + rel_path
                     if os.path.exists(local_file):
                         success += 1
                     elif result.returncode in (23, 24):
@@ -533,12 +577,8 @@ class BackupOptimizedMixin:
                         vanished += 1
                     else:
                         real_failed += 1
-                        state_manager.log_error(
-                            sync_id=sync_id,
-                            rel_path=rel_path,
-                            error_message="rsync: file not transferred",
-                            retry_count=0
-                        )
+                        not_transferred.append((sync_id, rel_path, "rsync: file not transferred", 0))
+                state_manager.log_errors_batch(not_transferred)
 
                 console.print(f"\n[green]✅ Download phase completed (rsync)[/green]")
                 console.print(f"[dim]   Success: {success:,} | "
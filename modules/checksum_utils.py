@@ -3,26 +3,97 @@ Checksum utilities for file verification
 More reliable than size comparison
 """
 import hashlib
+import mmap
 import os
+import re
 import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from modules.linux_optimized import stat_light
 
 logger = logging.getLogger(__name__)
 
+# Below this many files, starting a thread pool costs more than it saves
+HASH_PARALLEL_MIN = 16
+
+# From this size on, the file is mapped and hashed in a single update() call
+HASH_MMAP_MIN = 16 * 1024 * 1024
+
+# Slowest disk read rate assumed on the server when sizing hash timeouts
+REMOTE_HASH_MIN_RATE = 10 * 1024 * 1024
+
+# Hash command found on each server, probed once per SSH client: {ssh: {algorithm: cmd}}
+_remote_hash_commands = weakref.WeakKeyDictionary()
+
+# Idle persistent hashing sessions of each SSH client: {ssh: {algorithm: [RemoteHasher]}}.
+# A caller takes one for itself: threads sharing an SSH client hash concurrently
+_remote_hashers = weakref.WeakKeyDictionary()
+_remote_hashers_lock = threading.Lock()
+
+# Escapes used by *sum for file names containing a backslash or a newline
+_SUM_ESCAPE = re.compile(rb'\\(.)')
+_SUM_UNESCAPED = {b'n': b'\n', b'r': b'\r', b'\\': b'\\'}
+
 
 def calculate_file_hash(file_path: str, algorithm: str = 'md5', chunk_size: int = 65536) -> str:
     """Calculate file hash without loading entire file in memory"""
     hash_func = hashlib.new(algorithm)
     try:
         with open(file_path, 'rb') as f:
-            while chunk := f.read(chunk_size):
-                hash_func.update(chunk)
+            fd = f.fileno()
+            file_size = os.fstat(fd).st_size
+            
+            if file_size >= HASH_MMAP_MIN:
+                # No copies, and the GIL stays released for the whole file
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, 'madvise'):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    hash_func.update(mm)
+            elif file_size <= chunk_size:
+                # Small file (the common case): a single read
+                hash_func.update(f.read())
+            else:
+                if hasattr(os, 'posix_fadvise'):
+                    # Read once, front to back: let the kernel read ahead aggressively
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                if hasattr(hashlib, 'file_digest'):
+                    # Python 3.11+: reusable buffer, no bytes object per chunk
+                    hashlib.file_digest(f, lambda: hash_func)
+                else:
+                    buf = bytearray(chunk_size)
+                    view = memoryview(buf)
+                    while size := f.readinto(buf):
+                        hash_func.update(view[:size])
         return hash_func.hexdigest()
     except Exception as e:
         logger.warning(f"Failed to calculate hash for {file_path}: {e}")
         return None
 
 
-def calculate_remote_hash(ssh, remote_path: str, algorithm: str = 'md5') -> str:
+def hash_batch(paths, algorithm: str = 'md5', max_workers: int = None) -> dict:
+    """
+    Hash many local files at once on a thread pool (one thread per core by
+    default): hashlib releases the GIL while hashing buffers of 2 KiB or
+    more, and calculate_file_hash feeds it mmaps or 64 KiB chunks, so the
+    threads run on separate cores. No fork, no pickling of paths or digests:
+    safe to call while transfer threads are running.
+    Small batches, or a single core, are hashed in the calling thread.
+    
+    Returns:
+        {path: hash string, or None if the file could not be read}
+    """
+    paths = list(paths)
+    workers = min(max_workers or os.cpu_count() or 1, len(paths))
+    if workers > 1 and len(paths) >= HASH_PARALLEL_MIN:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(paths, executor.map(
+                lambda path: calculate_file_hash(path, algorithm), paths
+            )))
+    return {path: calculate_file_hash(path, algorithm) for path in paths}
+
+
+def calculate_remote_hash(ssh, remote_path: str, algorithm: str = 'md5', size: int = None) -> str:
     """
     Calculate hash on remote server using ssh if available.
     This avoids downloading the file just to verify it.
@@ -31,23 +102,30 @@ def calculate_remote_hash(ssh, remote_path: str, algorithm: str = 'md5') -> str:
         ssh: paramiko SSHClient
         remote_path: Path to file on remote server
         algorithm: Hash algorithm (md5, sha1, sha256)
+        size: File size when known: the wait is bounded by
+            remote_hash_timeout(size), unbounded otherwise
     
     Returns:
         Hash string if successful, None if failed
     """
+    timeout = remote_hash_timeout(size) if size is not None else None
+    
+    # Persistent session of this SSH client: no channel open + exec per file
+    hasher = _acquire_remote_hasher(ssh, algorithm)
+    if hasher is not None:
+        try:
+            # A session that timed out is not retried with exec_command: the
+            # same file would only time out a second time
+            return hasher.hash(remote_path, timeout=timeout)
+        finally:
+            _release_remote_hasher(ssh, hasher)
+    
     try:
         # Try native hash command (most servers have md5sum or sha256sum)
-        hash_cmd = f'{algorithm}sum'
-        
-        # Check which hash command is available
-        for cmd in [f'{algorithm}sum', f'{algorithm}']:
-            stdin, stdout, stderr = ssh.exec_command(f'command -v {cmd}', timeout=10)
-            if stdout.read().strip():
-                hash_cmd = cmd
-                break
+        hash_cmd = _remote_hash_command(ssh, algorithm) or f'{algorithm}sum'
         
         stdin, stdout, stderr = ssh.exec_command(
-            f'{hash_cmd} "{remote_path}"', timeout=60
+            f'{hash_cmd} "{remote_path}"', timeout=timeout
         )
         out = stdout.read().decode('utf-8', errors='replace').strip()
         err = stderr.read().decode('utf-8', errors='replace').strip()
@@ -72,6 +150,248 @@ def calculate_remote_hash(ssh, remote_path: str, algorithm: str = 'md5') -> str:
     return None
 
 
+def _acquire_remote_hasher(ssh, algorithm: str):
+    """
+    Idle RemoteHasher of this SSH client, or a new one (one channel per
+    concurrent caller); None if the server can't run a hashing session.
+    Give it back with _release_remote_hasher.
+    """
+    with _remote_hashers_lock:  # download workers may share an SSH client
+        idle = _remote_hashers.setdefault(ssh, {}).setdefault(algorithm, [])
+        while idle:
+            hasher = idle.pop()
+            if hasher.available:
+                return hasher
+    
+    # Opened outside the lock: other threads keep taking idle sessions meanwhile
+    try:
+        hasher = RemoteHasher(ssh, algorithm)
+    except Exception as e:
+        logger.debug(f"Remote hash session unavailable: {e}")
+        return None
+    return hasher if hasher.available else None
+
+
+def _release_remote_hasher(ssh, hasher):
+    """Back to the idle sessions of this SSH client (dropped if its channel died)"""
+    if not hasher.available:
+        return
+    with _remote_hashers_lock:
+        _remote_hashers.setdefault(ssh, {}).setdefault(hasher.algorithm, []).append(hasher)
+
+
+def _remote_hash_command(ssh, algorithm: str):
+    """Hash command available on the server (md5sum, md5...), None if neither; probed once per SSH client"""
+    commands = _remote_hash_commands.setdefault(ssh, {})
+    if algorithm not in commands:
+        hash_cmd = None
+        for cmd in [f'{algorithm}sum', f'{algorithm}']:
+            stdin, stdout, stderr = ssh.exec_command(f'command -v {cmd}', timeout=10)
+            if stdout.read().strip():
+                hash_cmd = cmd
+                break
+        commands[algorithm] = hash_cmd
+    return commands[algorithm]
+
+
+def remote_hash_timeout(size: int, minimum: float = 60) -> float:
+    """Seconds to wait for the server to hash `size` bytes (read at REMOTE_HASH_MIN_RATE)"""
+    return max(minimum, (size or 0) / REMOTE_HASH_MIN_RATE)
+
+
+def calculate_remote_hashes(ssh, remote_paths, algorithm: str = 'md5', timeout: float = 300) -> dict:
+    """
+    Hash many remote files with a single SSH command: the path list is piped
+    NUL-separated into `xargs -0 <algorithm>sum` on one channel, instead of
+    one exec_command (and one round-trip) per file.
+    
+    Args:
+        ssh: paramiko SSHClient
+        remote_paths: Paths of the files on the remote server
+        algorithm: Hash algorithm (md5, sha1, sha256)
+        timeout: Longest wait for the next output line, i.e. for one file
+            to be hashed (see remote_hash_timeout for the largest file)
+    
+    Returns:
+        {remote_path: hash string}; files the server could not hash are
+        missing (empty dict if the server has no {algorithm}sum command)
+    """
+    remote_paths = list(remote_paths)
+    hashes = {}
+    if not remote_paths:
+        return hashes
+    
+    try:
+        hash_cmd = _remote_hash_command(ssh, algorithm)
+        if hash_cmd != f'{algorithm}sum':
+            # BSD md5/sha256 print another format: callers fall back to per-file checks
+            logger.debug(f"No {algorithm}sum on server, batched remote hashing unavailable")
+            return hashes
+        
+        digest_len = hashlib.new(algorithm).digest_size * 2
+        payload = b''.join(path.encode('utf-8', 'surrogateescape') + b'\0' for path in remote_paths)
+        
+        channel = ssh.get_transport().open_session()
+        channel.settimeout(timeout)
+        channel.exec_command(f'xargs -0 -n 256 {hash_cmd} 2>/dev/null')
+        
+        # Paths are written from a thread while hashes are read here: with
+        # both channel windows full and nobody reading, both sides would block
+        def _write_paths():
+            try:
+                for offset in range(0, len(payload), 65536):
+                    channel.sendall(payload[offset:offset + 65536])
+            except Exception as e:
+                logger.debug(f"Remote hash path list write finished early: {e}")
+            finally:
+                try:
+                    channel.shutdown_write()
+                except Exception:
+                    pass
+        
+        writer = threading.Thread(target=_write_paths, daemon=True)
+        writer.start()
+        
+        try:
+            # Output lines: "<hash>  <path>", or a backslash + "<hash>  <escaped path>"
+            for line in channel.makefile('rb'):
+                line = line.rstrip(b'\n')
+                escaped = line.startswith(b'\\')
+                if escaped:
+                    line = line[1:]
+                digest, _, name = line.partition(b' ')
+                if len(digest) != digest_len or len(name) < 2:
+                    continue
+                name = name[1:]  # ' ' (text mode) or '*' (binary mode)
+                if escaped:
+                    name = _SUM_ESCAPE.sub(lambda m: _SUM_UNESCAPED.get(m.group(1), m.group(1)), name)
+                hashes[name.decode('utf-8', 'surrogateescape')] = digest.decode('ascii').lower()
+        finally:
+            channel.close()
+            writer.join(timeout=5)
+    except Exception as e:
+        logger.debug(f"Batched remote hash calculation failed: {e}")
+    
+    return hashes
+
+
+class RemoteHasher:
+    """
+    Persistent hashing session on a single SSH channel: a shell loop reads
+    one path per line and answers with its digest ('-' if the file can't be
+    hashed). Each hash() is one write and one line read on that channel,
+    instead of opening a channel and running {algorithm}sum per file.
+    
+    One request at a time per session (calls are serialized): concurrent
+    callers each use their own (see _acquire_remote_hasher). Usable as a
+    context manager.
+    """
+    
+    def __init__(self, ssh, algorithm: str = 'md5'):
+        self.algorithm = algorithm
+        self._lock = threading.Lock()
+        self._channel = None
+        self._reader = None
+        
+        hash_cmd = _remote_hash_command(ssh, algorithm)
+        if not hash_cmd:
+            logger.debug(f"No {algorithm} command on server, remote hash session unavailable")
+            return
+        
+        channel = ssh.get_transport().open_session()
+        # Content read from stdin: output is "<hash>  -" (or "<hash>" for BSD md5),
+        # never an escaped file name
+        channel.exec_command(
+            f'exec 2>/dev/null; while IFS= read -r p; do '
+            f'h=$({hash_cmd} < "$p") && echo "${{h%% *}}" || echo -; '
+            f'done'
+        )
+        self._channel = channel
+        self._reader = channel.makefile('rb')
+    
+    @property
+    def available(self) -> bool:
+        """False once the channel is closed (or if the server has no hash command)"""
+        return self._channel is not None
+    
+    def hash(self, remote_path: str, timeout: float = None):
+        """
+        Hash of a remote file, None if it can't be hashed. `timeout` bounds
+        the wait for this file (see remote_hash_timeout); None waits as long
+        as the server needs. On timeout the session is closed.
+        """
+        if '\n' in remote_path:
+            return None  # the loop reads one path per line
+        
+        with self._lock:
+            if self._channel is None:
+                return None
+            try:
+                self._channel.settimeout(timeout)
+                self._channel.sendall(remote_path.encode('utf-8', 'surrogateescape') + b'\n')
+                line = self._reader.readline()
+            except Exception as e:
+                # Timeout or dead channel: the next answer could be out of step
+                logger.debug(f"Remote hash session failed: {e}")
+                line = b''
+            if not line:
+                self._close()
+                return None
+        
+        digest = line.strip().decode('ascii', errors='replace').lower()
+        return None if digest == '-' else digest
+    
+    def _close(self):
+        channel, self._channel = self._channel, None
+        if channel is not None:
+            try:
+                channel.close()
+            except Exception:
+                pass
+    
+    def close(self):
+        with self._lock:
+            self._close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def size_tolerance(expected_size: int) -> int:
+    """Accepted size difference for a size-only check: 0.1% or 10 bytes"""
+    return max(expected_size // 1000, 10)
+
+
+def verify_sizes_bulk(local_sizes, expected_sizes, tolerant: bool = False) -> list:
+    """
+    Size check for many files at once: one pass over two parallel
+    sequences, no per-file call.
+    
+    Sizes must match exactly unless `tolerant`, which accepts the
+    size_tolerance() difference of verify_download_integrity's fallback.
+    A local size of None (missing file) fails; an expected size of
+    0/None is not checked.
+    
+    Returns:
+        list of bool, True where the file passes
+    """
+    if not tolerant:
+        return [
+            local_size is not None and (not expected_size or local_size == expected_size)
+            for local_size, expected_size in zip(local_sizes, expected_sizes)
+        ]
+    return [
+        local_size is not None and (
+            not expected_size
+            or abs(local_size - expected_size) <= size_tolerance(expected_size)
+        )
+        for local_size, expected_size in zip(local_sizes, expected_sizes)
+    ]
+
+
 def verify_download_integrity(ssh, sftp, local_path: str, remote_path: str, 
                              expected_hash: str = None, expected_size: int = None,
                              algorithm: str = 'md5') -> tuple:
@@ -86,12 +406,12 @@ def verify_download_integrity(ssh, sftp, local_path: str, remote_path: str,
     Returns:
         (success: bool, message: str)
     """
-    # Check local file exists
-    if not os.path.exists(local_path):
+    # Check local file exists (a single statx: exists + getsize made two stat calls)
+    try:
+        local_size = stat_light(local_path)[0]
+    except OSError:
         return False, "File doesn't exist"
     
-    local_size = os.path.getsize(local_path)
-    
     # Option 1: Verify with expected hash (most reliable)
     if expected_hash:
         local_hash = calculate_file_hash(local_path, algorithm)
@@ -102,7 +422,7 @@ def verify_download_integrity(ssh, sftp, local_path: str, remote_path: str,
     
     # Option 2: Calculate remote hash and compare with local
     if ssh:
-        remote_hash = calculate_remote_hash(ssh, remote_path, algorithm)
+        remote_hash = calculate_remote_hash(ssh, remote_path, algorithm, size=expected_size or local_size)
         if remote_hash:
             local_hash = calculate_file_hash(local_path, algorithm)
             if local_hash and local_hash.lower() == remote_hash.lower():
@@ -112,7 +432,7 @@ def verify_download_integrity(ssh, sftp, local_path: str, remote_path: str,
     
     # Option 3: Fall back to size comparison
     if expected_size:
-        tolerance = max(int(expected_size * 0.001), 10)  # 0.1% or 10 bytes
+        tolerance = size_tolerance(expected_size)
         if abs(local_size - expected_size) <= tolerance:
             return True, f"Size verified (tolerance: {tolerance} bytes)"
         return False, f"Size mismatch: expected {expected_size}, got {local_size} (tolerance: {tolerance})"
@@ -121,6 +441,63 @@ def verify_download_integrity(ssh, sftp, local_path: str, remote_path: str,
     return True, "No verification performed"
 
 
+def bulk_remote_stat(ssh, root: str, errors: list = None):
+    """
+    Size and mtime of every file under `root` from a single
+    `find -printf` on the server: one stream for the whole subtree
+    instead of one SFTP stat per file.
+    
+    Yields:
+        (rel_path, size, mtime) - rel_path relative to root, mtime in
+        epoch seconds (None if unparsable)
+    
+    Lines find writes to stderr (unreadable directories...) are appended
+    to `errors` when given. Raises RuntimeError if find fails without any
+    output (e.g. no -printf support): callers fall back to SFTP.
+    """
+    # %P = relative path, %s = size in bytes, %T@ = mtime as epoch seconds
+    cmd = f'find -L "{root}" -type f -printf "%P\\t%s\\t%T@\\n"'
+    stdin, stdout, stderr = ssh.exec_command(cmd, timeout=3600)
+    
+    found = 0
+    pending = b''
+    while True:
+        chunk = stdout.read(65536)
+        if not chunk:
+            lines = [pending] if pending else []
+        else:
+            # Split each chunk once; the partial last line waits for the next one
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+        
+        for line in lines:
+            # Split from the right: the path itself may contain tabs
+            parts = line.decode('utf-8', errors='replace').rsplit('\t', 2)
+            if len(parts) != 3 or not parts[0]:
+                continue  # malformed, or the root directory itself
+            rel_path, size_str, mtime_str = parts
+            try:
+                size = int(size_str)
+            except ValueError:
+                size = 0
+            try:
+                mtime = int(mtime_str.partition('.')[0])
+            except ValueError:
+                mtime = None
+            found += 1
+            yield rel_path, size, mtime
+        
+        if not chunk:
+            break
+    
+    exit_code = stdout.channel.recv_exit_status()
+    err_output = stderr.read().decode('utf-8', errors='replace').strip()
+    if exit_code != 0 and not found:
+        raise RuntimeError(f"find failed (exit {exit_code}): {err_output}")
+    if errors is not None and err_output:
+        errors.extend(err_output.splitlines())
+
+
 def get_remote_file_info(ssh, sftp, remote_path: str) -> dict:
     """
     Get file info from remote server using multiple methods.
@@ -146,7 +523,7 @@ def get_remote_file_info(ssh, sftp, remote_path: str) -> dict:
                 info['is_symlink'] = True
             
             # Try to get hash via ssh
-            info['hash'] = calculate_remote_hash(ssh, remote_path, 'md5')
+            info['hash'] = calculate_remote_hash(ssh, remote_path, 'md5', size=attr.st_size)
             
     except Exception as e:
         logger.debug(f"Failed to get remote file info: {e}")
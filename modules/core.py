@@ -1,21 +1,33 @@
 import os
 import json
 import logging
+import re
+import socket
 import sys
-from ftplib import FTP
+from collections import deque
+from ftplib import FTP, error_perm
 from datetime import datetime
 from dotenv import load_dotenv
 from rich.console import Console
 from rich.logging import RichHandler
 from modules.sftp_adapter import SFTPAdapter
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Load environment variables
 load_dotenv()
 
 # Setup logging with Rich
 LOG_DIR = './logs'
-if not os.path.exists(LOG_DIR):
-    os.makedirs(LOG_DIR)
+os.makedirs(LOG_DIR, exist_ok=True)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -29,6 +41,160 @@ logging.basicConfig(
 
 console = Console()
 
+# Tampon des fichiers d'état : json.dump émet de nombreux petits write()
+STATE_IO_BUFFER = 64 * 1024
+
+# Taille des blocs RETR/STOR (ftplib utilise 8 KB par défaut)
+TRANSFER_BLOCKSIZE = 1024 * 1024
+
+# Tampons TCP (réception, et émission pour les uploads) des connexions FTP.
+# 0 par défaut : le noyau ajuste lui-même les tampons (autotuning), qu'une
+# valeur explicite désactive et plafonne à 2 × net.core.rmem_max / wmem_max
+FTP_SOCKET_BUFFER = int(os.getenv('FTP_SOCKET_BUFFER', 0))
+
+# Fenêtre et taille de paquet des canaux SFTP (0 : valeurs de paramiko, 2 MB / 32 KB)
+SFTP_WINDOW_SIZE = int(os.getenv('SFTP_WINDOW_SIZE', 0))
+SFTP_MAX_PACKET_SIZE = int(os.getenv('SFTP_MAX_PACKET_SIZE', 0))
+
+
+def compile_exclude_patterns(patterns):
+    """
+    Compile les règles d'exclusion en une seule regex (une passe par chemin) :
+      'dir/'  → un composant du chemin vaut 'dir'
+      '*.ext' → le chemin se termine par '.ext'
+      autre   → sous-chaîne du chemin
+    """
+    dir_names = [re.escape(p.rstrip('/')) for p in patterns if p.endswith('/')]
+    suffixes = [re.escape(p[2:]) for p in patterns if not p.endswith('/') and p.startswith('*.')]
+    substrings = [re.escape(p) for p in patterns if not p.endswith('/') and not p.startswith('*.')]
+    
+    # Une alternation par type de règle, ancrage en tête de groupe : à chaque
+    # position, le moteur ne teste que 3 entrées ('/' ou début, '.', littéraux)
+    # au lieu d'essayer chaque règle (~6× plus rapide sur des chemins longs)
+    parts = []
+    if dir_names:
+        parts.append(r'(?:^|/)(?:' + '|'.join(dir_names) + r')(?:/|\Z)')
+    if suffixes:
+        parts.append(r'\.(?:' + '|'.join(suffixes) + r')\Z')
+    parts.extend(substrings)
+    # Sans règle, une regex qui ne matche jamais
+    return re.compile('|'.join(parts) or r'(?!)')
+
+def _split_exclude_patterns(patterns):
+    """
+    Règles séparées par type : (noms de dossiers en frozenset, suffixes en
+    tuple pour un seul endswith, sous-chaînes). None si une règle contient un
+    '/' interne ou est vide : seule la regex est alors exacte.
+    """
+    if any('/' in pattern.rstrip('/') or not pattern.rstrip('/') for pattern in patterns):
+        return None
+    dir_names = frozenset(p.rstrip('/') for p in patterns if p.endswith('/'))
+    suffixes = tuple(p[1:] for p in patterns if not p.endswith('/') and p.startswith('*.'))
+    substrings = tuple(p for p in patterns if not p.endswith('/') and not p.startswith('*.'))
+    return dir_names, suffixes, substrings
+
+def make_path_exclude(patterns):
+    """
+    Prédicat d'exclusion d'un chemin isolé (should_exclude) : composants
+    comparés au frozenset des dossiers, suffixes en un appel endswith, puis
+    sous-chaînes ; sans regex quand _split_exclude_patterns le permet.
+    """
+    rules = _split_exclude_patterns(patterns)
+    if rules is None:
+        search = compile_exclude_patterns(patterns).search
+        return lambda path: search(path) is not None
+    
+    dir_names, suffixes, substrings = rules
+    
+    def excluded(path):
+        if path.endswith(suffixes) or not dir_names.isdisjoint(path.split('/')):
+            return True
+        for substring in substrings:
+            if substring in path:
+                return True
+        return False
+    
+    return excluded
+
+def make_exclude_filter(patterns):
+    """
+    Prédicat d'exclusion pour un grand nombre de chemins : la décision sur le
+    dossier parent est mémorisée, seul le nom de fichier est testé ensuite.
+    Exact tant qu'aucune règle ne contient de '/' interne (aucune correspondance
+    ne peut alors chevaucher deux composants) ni n'est vide ; sinon, test du
+    chemin complet.
+    
+    Le nom de fichier est testé règle par règle (ensemble, endswith, `in`) :
+    la regex, essayée à chaque position du nom, reste ~3× plus lente.
+    """
+    search = compile_exclude_patterns(patterns).search
+    rules = _split_exclude_patterns(patterns)
+    if rules is None:
+        return lambda path: search(path) is not None
+
+    # Mêmes règles que compile_exclude_patterns, appliquées à un seul composant
+    dir_names, suffixes, substrings = rules
+
+    def name_excluded(name):
+        if name in dir_names or name.endswith(suffixes):
+            return True
+        for substring in substrings:
+            if substring in name:
+                return True
+        return False
+
+    dir_cache = {}
+
+    def excluded(path):
+        parent, sep, name = path.rpartition('/')
+        if not sep:
+            return name_excluded(path)
+        hit = dir_cache.get(parent)
+        if hit is None:
+            hit = dir_cache[parent] = search(parent + '/') is not None
+        return hit or name_excluded(name)
+
+    return excluded
+
+class TunedFTP(FTP):
+    """
+    FTP dont les sockets (contrôle et données) ont des tampons élargis : la
+    fenêtre TCP n'est plus le plafond de débit sur un lien à forte latence
+    (débit max ≈ SO_RCVBUF / RTT en download, SO_SNDBUF / RTT en upload).
+    Un tampon n'est jamais réduit : la taille demandée n'est appliquée que si
+    elle dépasse la valeur actuelle du socket.
+    """
+    def __init__(self, *args, rcvbuf=0, sndbuf=0, **kwargs):
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        super().__init__(*args, **kwargs)
+
+    def _tune(self, sock):
+        for option, size in ((socket.SO_RCVBUF, self.rcvbuf), (socket.SO_SNDBUF, self.sndbuf)):
+            if size:
+                try:
+                    if sock.getsockopt(socket.SOL_SOCKET, option) < size:
+                        sock.setsockopt(socket.SOL_SOCKET, option, size)
+                except OSError:
+                    pass
+        return sock
+
+    def connect(self, *args, **kwargs):
+        welcome = super().connect(*args, **kwargs)
+        self._tune(self.sock)
+        # Canal de contrôle : petites commandes en aller-retour, sans attente de Nagle
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        return welcome
+
+    def ntransfercmd(self, cmd, rest=None):
+        # Nagle reste actif sur le canal de données (transfert en masse)
+        conn, size = super().ntransfercmd(cmd, rest)
+        return self._tune(conn), size
+
+
 class SynergyCore:
     DEPLOY_STATE_FILE = '.deploy_enabled'
     PROTECTED_PATHS = ['/', '/ftp', '/production', '/prod', '/live', '/www', '/public_html']
@@ -41,6 +207,8 @@ class SynergyCore:
     ]
     
     def __init__(self):
+        self.server_features = None  # Réponse FEAT (lue à la première connexion)
+        self.known_remote_dirs = set()  # Dossiers distants dont l'existence est confirmée
         self.ftp_host = os.getenv('FTP_HOST')
         self.ftp_port = int(os.getenv('FTP_PORT', 21))
         self.ftp_user = os.getenv('FTP_USER')
@@ -53,157 +221,415 @@ class SynergyCore:
             sys.exit(1)
         
         if self.ftp_port == 22:
-            ftp = SFTPAdapter(timeout=300)
+            ftp = SFTPAdapter(timeout=300, window_size=SFTP_WINDOW_SIZE or None,
+                              max_packet_size=SFTP_MAX_PACKET_SIZE or None)
         else:
-            ftp = FTP(timeout=300)
+            # Tampons du noyau (autotuning) sauf si FTP_SOCKET_BUFFER est fixé
+            ftp = TunedFTP(timeout=300, rcvbuf=FTP_SOCKET_BUFFER, sndbuf=FTP_SOCKET_BUFFER)
             
         ftp.connect(self.ftp_host, self.ftp_port)
         ftp.login(self.ftp_user, self.ftp_pass)
+        
+        if self.server_features is None:
+            self.server_features = self._read_features(ftp)
+        
+        # Ne demander que les facts utiles au listing MLSD
+        try:
+            ftp.sendcmd('OPTS MLST type;size;modify;')
+        except Exception:
+            pass
         return ftp
 
+    def _read_features(self, ftp):
+        """Extensions annoncées par le serveur (FEAT), en majuscules"""
+        try:
+            response = ftp.sendcmd('FEAT')
+        except Exception:
+            return set()
+        return {
+            line.strip().split(' ', 1)[0].upper()
+            for line in response.splitlines()[1:-1] if line.strip()
+        }
+
+    def mlsd_supported(self):
+        """
+        MLSD annoncé par le serveur (extension MLST dans FEAT). Sans réponse
+        FEAT (serveur muet, adaptateur SFTP), supposé disponible.
+        """
+        return not self.server_features or 'MLST' in self.server_features
+
+    def list_dir(self, ftp, path):
+        """
+        Liste un dossier au format MLSD : [(name, facts)].
+        
+        Utilise MLSC (listing sur le canal de contrôle, sans connexion de
+        données) si le serveur l'annonce dans FEAT, sinon ftp.mlsd().
+        """
+        if self.server_features and 'MLSC' in self.server_features:
+            response = ftp.sendcmd(f'MLSC {path}')
+            entries = []
+            for line in response.splitlines()[1:-1]:
+                facts_found, _, name = line.lstrip().partition(' ')
+                if not name:
+                    continue
+                facts = {}
+                for fact in facts_found.rstrip(';').split(';'):
+                    key, _, value = fact.partition('=')
+                    facts[key.lower()] = value
+                entries.append((name, facts))
+            return entries
+        return list(ftp.mlsd(path))
+
     def get_local_files(self, local_root):
+        """
+        Inventaire local via os.scandir : la taille et la date viennent du
+        DirEntry (souvent sans stat() supplémentaire par fichier).
+        'modify' est l'epoch en secondes (texte), sans formatage datetime.
+        Les dates sont internées : beaucoup de fichiers partagent la même seconde.
+        Pas de cache de signatures sur disque : (taille, mtime) lus ici sont
+        déjà la signature comparée à la base d'état, et les obtenir coûte
+        le même stat() que vérifier une clé de cache.
+        """
         files = {}
         if not os.path.exists(local_root):
             return files
-        for root, dirs, filenames in os.walk(local_root):
-            for name in filenames:
-                full_path = os.path.join(root, name)
-                rel_path = os.path.relpath(full_path, local_root).replace('\\', '/')
-                stat = os.stat(full_path)
-                files[rel_path] = {
-                    'size': stat.st_size,
-                    'modify': datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                }
+        
+        # Date texte par seconde epoch : une conversion (et un intern) par valeur
+        # distincte, les fichiers d'un même lot partageant souvent la même seconde
+        modify_strings = {}
+        
+        def scan(path, rel_prefix):
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError as e:
+                logging.warning(f"Cannot read directory {path}: {e}")
+                return
+            
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    scan(entry.path, rel_prefix + entry.name + '/')
+                elif entry.is_dir():
+                    # Lien symbolique vers un dossier : ignoré, comme os.walk
+                    continue
+                else:
+                    try:
+                        stat = entry.stat()
+                    except OSError as e:
+                        # Lien symbolique cassé, fichier supprimé pendant le parcours
+                        logging.warning(f"Cannot stat {entry.path}: {e}")
+                        continue
+                    # Chemin relatif en '/' construit par dossier (pas de découpe + replace par fichier)
+                    mtime = int(stat.st_mtime)
+                    modify = modify_strings.get(mtime)
+                    if modify is None:
+                        modify = modify_strings[mtime] = sys.intern(str(mtime))
+                    files[rel_prefix + entry.name] = {
+                        'size': stat.st_size,
+                        'modify': modify,
+                    }
+        
+        scan(local_root, '')
         return files
 
-    def get_remote_files(self, ftp, remote_root, base_path=None, status=None, _count=None):
-        if _count is None: _count = [0]
-        if base_path is None: base_path = ''
+    def _mlst_modify(self, ftp, path):
+        """Fact 'modify' d'un chemin via MLST (canal de contrôle), ou None"""
+        try:
+            response = ftp.sendcmd(f'MLST {path}')
+        except Exception:
+            return None
+        for line in response.splitlines()[1:-1]:
+            facts = line.strip().split(' ', 1)[0]
+            for fact in facts.split(';'):
+                key, _, value = fact.partition('=')
+                if key.lower() == 'modify':
+                    return value
+        return None
 
+    def get_remote_files(self, ftp, remote_root, base_path=None, status=None,
+                         state_manager=None, dir_states=None, exclude=None):
+        """
+        Scan distant complet sous forme de dict {rel_path: {'size', 'modify'}}
+        (voir iter_remote_files pour le parcours et les paramètres).
+        """
         files = {}
-        current_path = os.path.join(remote_root, base_path).replace('\\', '/')
+        for rel_path, size, modify in self.iter_remote_files(
+                ftp, remote_root, base_path=base_path, status=status,
+                state_manager=state_manager, dir_states=dir_states, exclude=exclude):
+            files[rel_path] = {'size': size, 'modify': modify}
+        return files
+
+    def iter_remote_files(self, ftp, remote_root, base_path=None, status=None,
+                          state_manager=None, dir_states=None, exclude=None):
+        """
+        Parcours itératif (BFS) de l'arborescence distante sur une seule connexion.
+        Produit les fichiers au fil du scan, en tuples (rel_path, size, modify) :
+        l'appelant peut les écrire ailleurs sans construire de dict.
         
-        try:
-            ftp.cwd(current_path)
-            items = []
+        MLSD (ou MLSC, voir list_dir) est envoyé avec le chemin absolu de
+        chaque dossier : pas de CWD par dossier, facts déjà parsés.
+        Fallback LIST si le serveur ne supporte pas MLSD : décidé une fois
+        (FEAT sans MLST, ou premier refus 500/502), pas retenté à chaque dossier.
+        
+        Si `state_manager` et `dir_states` (listings précédents, voir
+        StateManager.get_directory_states) sont fournis, un dossier dont la date
+        'modify' n'a pas changé n'est pas re-listé : ses fichiers sont repris de
+        la base. `dir_states` est mis à jour en place avec l'état de ce scan.
+        
+        `exclude` (ex. self.should_exclude) : un sous-dossier dont tous les
+        fichiers seraient exclus (test sur 'chemin/') n'est pas parcouru.
+        """
+        count = 0
+        use_mlsd = self.mlsd_supported()
+        use_cache = state_manager is not None and dir_states is not None
+        cached_dirs = dict(dir_states) if use_cache else {}
+        if use_cache:
+            dir_states.clear()
+            # Sous-dossiers connus de chaque dossier (pour descendre sans lister)
+            cached_children = {}
+            for rel_dir in cached_dirs:
+                cached_children.setdefault(rel_dir.rpartition('/')[0], []).append(rel_dir)
+        now = datetime.now().isoformat()
+        subdirs = {}
+        
+        # (chemin relatif, fact modify connu ou None)
+        queue = deque([(base_path or '', None)])
+        # Chemins distants toujours en '/' : concaténation, sans os.path.join + replace
+        remote_prefix = remote_root.rstrip('/') + '/'
+        
+        def enqueue(rel_dir, modify):
+            if exclude is not None and exclude(rel_dir + '/'):
+                # Sous-arbre exclu : non listé, mais compté comme sous-dossier
+                # (le parent ne sera pas mis en cache sans lui)
+                subdirs.setdefault(rel_dir.rpartition('/')[0], []).append(rel_dir)
+                return
+            queue.append((rel_dir, modify))
+        
+        while queue:
+            rel_dir, modify = queue.popleft()
+            if rel_dir:
+                subdirs.setdefault(rel_dir.rpartition('/')[0], []).append(rel_dir)
+            current_path = remote_prefix + rel_dir
+            prefix = rel_dir + '/' if rel_dir else ''
+            
+            cached = cached_dirs.get(rel_dir)
+            if cached and rel_dir:
+                if modify is None:
+                    modify = self._mlst_modify(ftp, current_path)
+                if modify and modify == cached['modify']:
+                    # Dossier inchangé : réutiliser les fichiers et sous-dossiers connus
+                    reused = state_manager.get_files_in_directory(rel_dir)
+                    for rel_path, info in reused.items():
+                        yield rel_path, info['size'], info['modify']
+                    count += len(reused)
+                    dir_states[rel_dir] = cached
+                    for child in cached_children.get(rel_dir, []):
+                        enqueue(child, None)
+                    continue
             
-            # Try MLSD first (more reliable)
             try:
-                ftp.retrlines('MLSD', items.append)
+                # Try MLSD first (more reliable)
+                entries = None
+                if use_mlsd:
+                    try:
+                        entries = self.list_dir(ftp, current_path)
+                    except error_perm as e:
+                        # Commande inconnue : LIST pour le reste du scan, sans
+                        # un aller-retour MLSD perdu par dossier
+                        if str(e)[:3] in ('500', '502'):
+                            use_mlsd = False
+                    except Exception:
+                        pass
                 
-                for item in items:
-                    parts = item.split(';')
-                    name = parts[-1].strip()
-                    
-                    if name in ('.', '..'):
-                        continue
+                if entries is not None:
+                    for name, facts in entries:
+                        entry_type = facts.get('type')
+                        if entry_type == 'dir':
+                            enqueue(prefix + name, facts.get('modify'))
+                        elif entry_type == 'file':
+                            yield prefix + name, int(facts.get('size', 0)), sys.intern(facts.get('modify', ''))
+                            count += 1
                     
-                    props = {p.split('=')[0]: p.split('=')[1] for p in parts[:-1] if '=' in p}
-                    rel_path = os.path.join(base_path, name).replace('\\', '/')
+                    if use_cache and rel_dir and modify:
+                        dir_states[rel_dir] = {'modify': modify, 'last_listed': now}
+                else:
+                    # Fallback to LIST/DIR if MLSD not supported
+                    items = []
+                    ftp.dir(current_path, items.append)
                     
-                    if props.get('type') == 'dir':
-                        files.update(self.get_remote_files(ftp, remote_root, rel_path, status, _count))
-                    elif props.get('type') == 'file':
-                        files[rel_path] = {
-                            'size': int(props.get('size', 0)),
-                            'modify': props.get('modify', ''),
-                        }
-                        _count[0] += 1
-                        if status and _count[0] % 10 == 0:
-                            status.update(f"[bold cyan]Scanning... found {_count[0]} files so far")
-            except:
-                # Fallback to LIST/DIR if MLSD not supported
-                items = []
-                ftp.dir(items.append)
+                    for item in items:
+                        parts = item.split(None, 8)
+                        if len(parts) < 9:
+                            continue
+                        
+                        permissions = parts[0]
+                        name = parts[8]
+                        
+                        if name in ('.', '..'):
+                            continue
+                        
+                        if permissions.startswith('d'):
+                            enqueue(prefix + name, None)
+                        else:
+                            yield prefix + name, int(parts[4]), ''
+                            count += 1
                 
-                for item in items:
-                    parts = item.split(None, 8)
-                    if len(parts) < 9:
-                        continue
-                    
-                    permissions = parts[0]
-                    name = parts[8]
-                    
-                    if name in ('.', '..'):
-                        continue
-                    
-                    rel_path = os.path.join(base_path, name).replace('\\', '/')
-                    
-                    if permissions.startswith('d'):
-                        files.update(self.get_remote_files(ftp, remote_root, rel_path, status, _count))
-                    else:
-                        files[rel_path] = {
-                            'size': int(parts[4]),
-                            'modify': '',
-                        }
-                        _count[0] += 1
-                        if status and _count[0] % 10 == 0:
-                            status.update(f"[bold cyan]Scanning... found {_count[0]} files so far")
+                if status:
+                    status.update(f"[bold cyan]Scanning... found {count} files so far")
                         
-        except Exception as e:
-            logging.error(f"Error scanning {current_path}: {e}")
+            except Exception as e:
+                logging.error(f"Error scanning {current_path}: {e}")
         
-        return files
+        if use_cache:
+            # Un dossier n'est réutilisable que si tous ses sous-dossiers le sont
+            # (sinon ils ne seraient plus découverts au prochain scan)
+            for rel_dir in sorted(dir_states, key=lambda d: d.count('/'), reverse=True):
+                if any(child not in dir_states for child in subdirs.get(rel_dir, [])):
+                    del dir_states[rel_dir]
 
     def ensure_remote_dir(self, ftp, remote_dir):
-        if not remote_dir or remote_dir == '/':
+        """
+        Crée au besoin remote_dir et ses parents, en limitant les allers-retours :
+        un dossier déjà présent valide tous ses parents d'un seul CWD, et sous
+        un dossier qu'on vient de créer, les suivants sont créés sans CWD de test.
+        """
+        parts = [part for part in remote_dir.strip('/').split('/') if part]
+        if not parts:
             return
-            
-        parts = remote_dir.strip('/').split('/')
+        
+        known = self.known_remote_dirs
+        paths = []
         current = ''
         for part in parts:
-            if not part: continue
             current += '/' + part
+            paths.append(current)
+        
+        # Composants au-delà du plus profond dossier déjà connu
+        start = len(paths)
+        while start > 0 and paths[start - 1] not in known:
+            start -= 1
+        if start == len(paths):
+            return
+        
+        if len(paths) - start > 1:
             try:
-                ftp.cwd(current)
+                ftp.cwd(paths[-1])
             except Exception:
+                pass
+            else:
+                known.update(paths)
+                return
+        
+        created_parent = False
+        for current in paths[start:]:
+            if not created_parent:
                 try:
-                    logging.info(f"Creating directory: {current}")
-                    ftp.mkd(current)
                     ftp.cwd(current)
-                except Exception as e:
-                    logging.warning(f"Could not create or enter {current}: {e}")
+                    known.add(current)
+                    continue
+                except Exception:
+                    pass
+            try:
+                logging.info(f"Creating directory: {current}")
+                ftp.mkd(current)
+                known.add(current)
+                created_parent = True
+            except Exception as e:
+                created_parent = False
+                logging.warning(f"Could not create or enter {current}: {e}")
 
     def is_protected_path(self, remote_path):
         """Vérifie si le chemin est protégé"""
         normalized = remote_path.rstrip('/')
         return any(normalized == protected.rstrip('/') for protected in self.PROTECTED_PATHS)
     
+    def _path_exclude(self):
+        """Prédicat des exclusions, reconstruit seulement si EXCLUDE_PATTERNS change"""
+        patterns = tuple(self.EXCLUDE_PATTERNS)
+        cached = getattr(self, '_exclude_predicate', None)
+        if cached is None or cached[0] != patterns:
+            cached = self._exclude_predicate = (patterns, make_path_exclude(patterns))
+        return cached[1]
+
     def should_exclude(self, file_path):
         """Vérifie si un fichier doit être exclu du backup"""
-        for pattern in self.EXCLUDE_PATTERNS:
-            if pattern.endswith('/'):
-                # Dossier
-                if pattern.rstrip('/') in file_path.split('/'):
-                    return True
-            elif pattern.startswith('*.'):
-                # Extension
-                if file_path.endswith(pattern[1:]):
-                    return True
-            elif pattern in file_path:
-                # Pattern exact
-                return True
-        return False
+        return self._path_exclude()(file_path)
+    
+    def remove_excluded(self, files):
+        """
+        Retire sur place les chemins exclus d'un dict {rel_path: info}.
+        Retourne le nombre d'entrées retirées (le dict n'est pas reconstruit).
+        Filtre séquentiel : mémorisé par dossier, il coûte moins que l'envoi
+        des chemins à un pool de processus et le retour des résultats.
+        """
+        is_excluded = make_exclude_filter(self.EXCLUDE_PATTERNS)
+        excluded = [rel_path for rel_path in files if is_excluded(rel_path)]
+        for rel_path in excluded:
+            del files[rel_path]
+        return len(excluded)
     
     def verify_file_integrity(self, local_file, expected_size):
         """Vérifie l'intégrité du fichier téléchargé avec tolérance"""
-        if not os.path.exists(local_file):
+        # Un seul stat (exists + getsize en faisaient deux)
+        try:
+            actual_size = os.stat(local_file).st_size
+        except FileNotFoundError:
             return False, "File doesn't exist"
         
-        actual_size = os.path.getsize(local_file)
+        return self.verify_file_integrity_streaming(actual_size, expected_size)
+
+    def verify_file_integrity_streaming(self, received_bytes, expected_size):
+        """Même contrôle, à partir des octets comptés pendant le transfert (aucun accès disque)"""
         # Tolérance de 0.1% pour les différences de taille dues à l'encodage/transfert
         tolerance = max(int(expected_size * 0.001), 10)  # 0.1% ou minimum 10 bytes
-        if abs(actual_size - expected_size) > tolerance:
-            return False, f"Size mismatch: expected {expected_size}, got {actual_size} (tolerance: {tolerance})"
+        if abs(received_bytes - expected_size) > tolerance:
+            return False, f"Size mismatch: expected {expected_size}, got {received_bytes} (tolerance: {tolerance})"
         
         return True, "OK"
 
+    def open_state_db(self, state_file):
+        """
+        Ouvre la base SQLite associée à un fichier d'état (.json → .db).
+        Un ancien état JSON est migré automatiquement au premier usage.
+        """
+        from modules.state_manager import StateManager
+        
+        db_file = os.path.splitext(state_file)[0] + '.db'
+        if os.path.exists(state_file) and not os.path.exists(db_file):
+            from modules.backup_optimized import migrate_json_to_sqlite
+            migrate_json_to_sqlite(state_file, db_file)
+        return StateManager(db_file)
+
     def load_state(self, path):
-        if os.path.exists(path):
-            with open(path, 'r') as f: 
-                return json.load(f)
-        return {}
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'rb', buffering=STATE_IO_BUFFER) as f:
+            data = f.read()
+        # Détection du format : un état JSON commence toujours par '{'
+        if data[:1] not in (b'{', b''):
+            if msgpack is None:
+                raise RuntimeError(f"{path} is a msgpack state file: pip install msgpack")
+            return msgpack.unpackb(data, raw=False)
+        if orjson:
+            return orjson.loads(data) if data else {}
+        return json.loads(data) if data else {}
 
     def save_state(self, path, state):
-        with open(path, 'w') as f: 
-            json.dump(state, f, indent=4)
+        # Format compact : le fichier d'état n'est lu que par l'outil
+        if path.endswith('.mp') and msgpack:
+            data = msgpack.packb(state, use_bin_type=True)
+        elif orjson:
+            data = orjson.dumps(state)
+        else:
+            data = json.dumps(state, separators=(',', ':')).encode('utf-8')
+        
+        # Écriture atomique : un crash en cours d'écriture laisse l'ancien état intact
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb', buffering=STATE_IO_BUFFER) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
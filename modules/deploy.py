@@ -1,11 +1,16 @@
 import os
+import posixpath
 import json
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from ftplib import error_perm
 from rich.table import Table
 from rich.panel import Panel
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TransferSpeedColumn, TimeRemainingColumn
 
-from modules.core import console
+from modules.core import console, TRANSFER_BLOCKSIZE
 
 class DeployMixin:
     def is_deploy_enabled(self):
@@ -60,9 +65,12 @@ class DeployMixin:
         else:
             console.print("\n[yellow]ℹ️  Deploy mode is already disabled.[/yellow]\n")
 
-    def deploy(self, local_path, remote_project_name, dry_run=False):
+    def deploy(self, local_path, remote_project_name, dry_run=False, num_workers=4):
         """
         Deploy files from local to FTP with multiple safety checks
+        
+        Args:
+            num_workers: Nombre de connexions FTP simultanées pour l'upload
         """
         # 🛡️ PROTECTION 0 : Vérifier que deploy est activé
         if not self.is_deploy_enabled():
@@ -76,7 +84,7 @@ class DeployMixin:
             console.print("="*70 + "\n")
             return
         
-        remote_path = os.path.join(self.remote_base, remote_project_name).replace('\\', '/')
+        remote_path = posixpath.join(self.remote_base, remote_project_name)
         
         # 🛡️ PROTECTION 1 : Vérifier chemins protégés
         if self.is_protected_path(remote_path):
@@ -112,7 +120,9 @@ class DeployMixin:
                 return
         
         state_file = f"state_deploy_{remote_project_name.replace('/', '_')}.json"
-        current_state = self.load_state(state_file)
+        state_manager = self.open_state_db(state_file)
+        # Anciens états : dates ISO → epoch (évite de tout ré-uploader une fois)
+        state_manager.convert_iso_modify_to_epoch()
         
         with console.status("[bold green]Scanning local files...") as status:
             local_files = self.get_local_files(local_path)
@@ -122,24 +132,20 @@ class DeployMixin:
             console.print("[bold red]❌ No files found in local directory![/bold red]\n")
             return
 
-        new_state = {}
-        files_to_upload = []
-        total_bytes = 0
-        
-        # Calculer les fichiers à uploader
-        for rel_path, info in local_files.items():
-            target_remote = os.path.join(remote_path, rel_path).replace('\\', '/')
-            needs_upload = rel_path not in current_state or \
-                           current_state[rel_path]['size'] != info['size'] or \
-                           current_state[rel_path]['modify'] != info['modify']
-            if needs_upload:
-                files_to_upload.append((rel_path, target_remote, info['size']))
-                total_bytes += info['size']
-            new_state[rel_path] = info
+        # Calculer les fichiers à uploader : merge-join sur la table triée, en un
+        # parcours, sans charger l'état précédent dans un dict en mémoire
+        changed_files, total_bytes, removed_files = state_manager.find_files_to_download(local_files)
+        # rel_path est déjà en '/' (get_local_files) : simple concaténation
+        remote_prefix = remote_path.rstrip('/') + '/'
+        files_to_upload = [
+            (rel_path, remote_prefix + rel_path, size)
+            for rel_path, size in changed_files
+        ]
 
         if not files_to_upload:
             console.print("[bold green]✅ Everything is up-to-date. No files to deploy.[/bold green]\n")
-            self.save_state(state_file, new_state)
+            if removed_files:
+                state_manager.delete_files(removed_files)
             return
 
         # 🛡️ PROTECTION 4 : Afficher preview détaillé
@@ -199,6 +205,9 @@ class DeployMixin:
         # 🚀 DEPLOY RÉEL
         console.print("\n[bold green]🚀 Starting real deployment...[/bold green]\n")
         
+        # Le serveur a pu changer depuis un deploy précédent dans ce processus
+        self.known_remote_dirs.clear()
+        
         with self.connect() as ftp:
             self.ensure_remote_dir(ftp, remote_path)
             
@@ -209,31 +218,21 @@ class DeployMixin:
                 TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
                 TransferSpeedColumn(),
                 TimeRemainingColumn(),
-                console=console
+                console=console,
+                refresh_per_second=4  # rendu allégé : la progression arrive déjà par paquets de 1 MiB
             ) as progress:
                 overall_task = progress.add_task("[green]Uploading...", total=total_bytes)
                 
-                upload_success = 0
-                upload_failed = 0
-                
-                for rel_path, target_remote, size in files_to_upload:
-                    progress.update(overall_task, description=f"[green]Uploading {rel_path}...")
-                    
-                    self.ensure_remote_dir(ftp, os.path.dirname(target_remote))
-                    
-                    try:
-                        with open(os.path.join(local_path, rel_path), 'rb') as f:
-                            ftp.storbinary(
-                                f"STOR {target_remote}", 
-                                f, 
-                                callback=lambda data: progress.update(overall_task, advance=len(data))
-                            )
-                        upload_success += 1
-                    except Exception as e:
-                        upload_failed += 1
-                        progress.console.log(f"[red]❌ Failed: {rel_path} - {e}[/red]")
+                upload_success, upload_failed = self._upload_files(
+                    files_to_upload, local_path, num_workers, progress, overall_task
+                )
         
-        self.save_state(state_file, new_state)
+        # Seules les lignes des fichiers uploadés sont réécrites
+        state_manager.update_file_batch({
+            rel_path: local_files[rel_path] for rel_path, target_remote, size in files_to_upload
+        })
+        if removed_files:
+            state_manager.delete_files(removed_files)
         
         # Résumé final
         console.print("\n" + "="*70)
@@ -252,3 +251,98 @@ class DeployMixin:
             console.print("[bold green]✅ Deployment completed successfully![/bold green]\n")
         else:
             console.print(f"[bold yellow]⚠️  Deployment completed with {upload_failed} errors. Check logs.[/bold yellow]\n")
+
+    def _upload_files(self, files_to_upload, local_path, num_workers, progress, overall_task):
+        """
+        Upload les fichiers en parallèle, chaque thread ayant sa propre connexion
+        (connectée au premier usage puis réutilisée). Retourne (succès, échecs).
+        """
+        thread_state = threading.local()
+        connections = []
+        counts = Counter()  # 'success' / 'failed'
+        lock = threading.Lock()
+        
+        # Un verrou par dossier distant : chaque dossier n'est créé qu'une fois,
+        # sans CWD/MKD concurrents sur le même chemin
+        dir_locks = {}
+        ensured_dirs = set()
+        
+        def ensure_dir_once(ftp, remote_dir):
+            if remote_dir in ensured_dirs:
+                return
+            with lock:
+                dir_lock = dir_locks.setdefault(remote_dir, threading.Lock())
+            with dir_lock:
+                if remote_dir not in ensured_dirs:
+                    self.ensure_remote_dir(ftp, remote_dir)
+                    ensured_dirs.add(remote_dir)
+        
+        local_prefix = os.path.join(local_path, '')
+        
+        def close_connection(ftp):
+            try:
+                ftp.quit()
+            except Exception:
+                try:
+                    ftp.close()
+                except Exception:
+                    pass
+        
+        def upload_worker(rel_path, target_remote):
+            ftp = getattr(thread_state, 'ftp', None)
+            if ftp is None:
+                ftp = self.connect()
+                thread_state.ftp = ftp
+                with lock:
+                    connections.append(ftp)
+            
+            progress.update(overall_task, description=f"[green]Uploading {rel_path}...")
+            ensure_dir_once(ftp, target_remote.rpartition('/')[0])
+            
+            opened = False
+            try:
+                with open(local_prefix + rel_path, 'rb', buffering=TRANSFER_BLOCKSIZE) as f:
+                    opened = True
+                    ftp.storbinary(
+                        f"STOR {target_remote}", 
+                        f, 
+                        blocksize=TRANSFER_BLOCKSIZE,
+                        callback=lambda data: progress.update(overall_task, advance=len(data))
+                    )
+                outcome = 'success'
+            except Exception as e:
+                outcome = 'failed'
+                progress.console.log(f"[red]❌ Failed: {rel_path} - {e}[/red]")
+                # Transfert coupé : connexion peut-être inutilisable, le prochain
+                # fichier de ce worker en ouvre une neuve (un refus 5xx du serveur
+                # ou un fichier local illisible la laissent intacte)
+                if opened and not isinstance(e, error_perm):
+                    thread_state.ftp = None
+                    with lock:
+                        connections.remove(ftp)
+                    close_connection(ftp)
+            
+            with lock:
+                counts[outcome] += 1
+        
+        try:
+            # Pas plus de workers (donc de connexions) que de fichiers
+            workers = max(1, min(num_workers, len(files_to_upload)))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(upload_worker, rel_path, target_remote)
+                    for rel_path, target_remote, size in files_to_upload
+                ]
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        # Échec de connexion du worker
+                        with lock:
+                            counts['failed'] += 1
+                        progress.console.log(f"[red]❌ Upload worker error: {e}[/red]")
+        finally:
+            for ftp in connections:
+                close_connection(ftp)
+        
+        return counts['success'], counts['failed']
@@ -4,7 +4,15 @@ Scan intelligent avec cache et détection des changements uniquement
 """
 
 import os
+import sys
 import time
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from contextlib import contextmanager
 from ftplib import FTP
 from datetime import datetime, timedelta
 from typing import Dict, Set, Optional, Tuple, List, Callable
@@ -12,18 +20,200 @@ from dataclasses import dataclass
 import hashlib
 import logging
 
+try:
+    import fcntl
+except ImportError:  # Windows : pas de verrou, écriture atomique seulement
+    fcntl = None
+from modules.checksum_utils import bulk_remote_stat
+
 logger = logging.getLogger(__name__)
 
+# Format colonne du cache de scan (remplace le pickle) :
+#   magic | longueur de l'en-tête (uint32) | en-tête JSON |
+#   offsets (int64, n+1) | sizes (int64, n) | index modify (int32, n) | chemins UTF-8
+# Les chemins sont triés : recherche par bisect, sans construire de dict.
+CACHE_MAGIC = b'DBSCAN1\n'
+
 
 @dataclass
 class ScanCache:
     """Cache des scans précédents"""
     directories: Dict[str, datetime]  # {path: last_modified}
-    files: Dict[str, Dict]  # {rel_path: {size, modify}}
+    files: Dict[str, Dict]  # {rel_path: {size, modify}} (ou ColumnarFiles au chargement)
     last_full_scan: datetime
     scan_strategy: str  # 'full', 'incremental', 'smart'
 
 
+class _PathColumn:
+    """Séquence des chemins triés, décodés à la demande depuis le blob"""
+
+    __slots__ = ('blob', 'offsets')
+
+    def __init__(self, blob: bytes, offsets: array):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+
+class ColumnarFiles(Mapping):
+    """
+    Vue {rel_path: {size, modify}} en lecture seule sur un cache colonne.
+    Aucun objet par entrée n'est créé au chargement : les valeurs sont
+    reconstruites à l'accès, les recherches se font par bisect.
+    """
+
+    def __init__(self, paths: _PathColumn, sizes: array, modify_idx: array, modifies: List[str]):
+        self._paths = paths
+        self._sizes = sizes
+        self._modify_idx = modify_idx
+        self._modifies = modifies
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __iter__(self):
+        blob = self._paths.blob
+        offsets = self._paths.offsets
+        for i in range(len(self._sizes)):
+            yield blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+
+    def _index(self, rel_path):
+        i = bisect_left(self._paths, rel_path)
+        if i < len(self._sizes) and self._paths[i] == rel_path:
+            return i
+        return -1
+
+    def __contains__(self, rel_path):
+        return isinstance(rel_path, str) and self._index(rel_path) >= 0
+
+    def __getitem__(self, rel_path):
+        i = self._index(rel_path) if isinstance(rel_path, str) else -1
+        if i < 0:
+            raise KeyError(rel_path)
+        return {'size': self._sizes[i], 'modify': self._modifies[self._modify_idx[i]]}
+
+    def items(self):
+        """Parcours séquentiel (sans bisect) : dict(files.items()) reste linéaire"""
+        sizes = self._sizes
+        modify_idx = self._modify_idx
+        modifies = self._modifies
+        for i, rel_path in enumerate(self):
+            yield rel_path, {'size': sizes[i], 'modify': modifies[modify_idx[i]]}
+
+
+def _read_column(mm, start: int, typecode: str, count: int, swap: bool) -> array:
+    """Copie une colonne du mmap dans un array (memcpy, pas d'objets Python)"""
+    column = array(typecode)
+    column.frombytes(mm[start:start + count * column.itemsize])
+    if swap:
+        column.byteswap()
+    return column
+
+
+def read_scan_cache(cache_file: str) -> Optional[ScanCache]:
+    """Charge un cache colonne ; None si le fichier n'est pas dans ce format"""
+    with open(cache_file, 'rb') as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = len(CACHE_MAGIC)
+            (header_len,) = struct.unpack_from('<I', mm, pos)
+            pos += 4
+            header = json.loads(mm[pos:pos + header_len])
+            pos += header_len
+
+            count = header['count']
+            swap = header['byteorder'] != sys.byteorder
+            offsets = _read_column(mm, pos, 'q', count + 1, swap)
+            pos += (count + 1) * 8
+            sizes = _read_column(mm, pos, 'q', count, swap)
+            pos += count * 8
+            modify_idx = _read_column(mm, pos, 'i', count, swap)
+            pos += count * 4
+            blob = mm[pos:pos + offsets[-1]]
+
+    files = ColumnarFiles(_PathColumn(blob, offsets), sizes, modify_idx,
+                          [sys.intern(m) for m in header['modifies']])
+    return ScanCache(
+        directories={path: datetime.fromisoformat(ts) for path, ts in header['directories'].items()},
+        files=files,
+        last_full_scan=datetime.fromisoformat(header['last_full_scan']),
+        scan_strategy=header['scan_strategy']
+    )
+
+
+@contextmanager
+def _locked_tmp_file(tmp_file: str):
+    """
+    Ouvre le .tmp du cache sous verrou exclusif (flock sur le .tmp lui-même,
+    sans fichier .lock laissé à côté) : deux backups lancés en parallèle sur
+    le même projet ne l'écrivent pas en même temps. Le verrou obtenu, le chemin
+    doit toujours désigner le fichier verrouillé : l'écrivain précédent a pu
+    le renommer en cache entre-temps, il faut alors rouvrir un nouveau .tmp.
+    """
+    while True:
+        f = open(tmp_file, 'ab')  # pas de troncature avant d'avoir le verrou
+        if fcntl is None:
+            break
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(tmp_file)):
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        f.truncate(0)
+        yield f
+    finally:
+        f.close()
+
+
+def write_scan_cache(cache_file: str, cache: ScanCache):
+    """Écrit le cache au format colonne (chemins triés), de façon atomique"""
+    offsets = array('q', [0])
+    sizes = array('q')
+    modify_idx = array('i')
+    modifies = {}
+    chunks = []
+    end = 0
+
+    for rel_path, info in sorted(cache.files.items()):
+        encoded = rel_path.encode('utf-8')
+        chunks.append(encoded)
+        end += len(encoded)
+        offsets.append(end)
+        sizes.append(info['size'])
+        modify_idx.append(modifies.setdefault(info['modify'], len(modifies)))
+
+    header = json.dumps({
+        'count': len(sizes),
+        'byteorder': sys.byteorder,
+        'modifies': list(modifies),
+        'directories': {path: ts.isoformat() for path, ts in cache.directories.items()},
+        'last_full_scan': cache.last_full_scan.isoformat(),
+        'scan_strategy': cache.scan_strategy,
+    }).encode('utf-8')
+
+    tmp_file = cache_file + '.tmp'
+    with _locked_tmp_file(tmp_file) as f:
+        f.write(CACHE_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        offsets.tofile(f)
+        sizes.tofile(f)
+        modify_idx.tofile(f)
+        f.writelines(chunks)
+        f.flush()
+        # Renommé sous verrou : un écrivain en attente verra un autre fichier au chemin .tmp
+        os.replace(tmp_file, cache_file)
+
+
 def _is_connection_dead(error_msg: str) -> bool:
     """Check if an error indicates a dead connection"""
     indicators = [
@@ -114,9 +304,9 @@ class IncrementalScanner:
         """Charge le cache depuis le disque"""
         if self.cache_file and os.path.exists(self.cache_file):
             try:
-                import pickle
-                with open(self.cache_file, 'rb') as f:
-                    return pickle.load(f)
+                cache = read_scan_cache(self.cache_file)
+                if cache is not None:
+                    return cache
             except Exception as e:
                 logger.debug(f"Failed to load cache: {e}")
 
@@ -132,12 +322,10 @@ class IncrementalScanner:
         """Sauvegarde le cache sur le disque"""
         if self.cache_file:
             try:
-                import pickle
                 dirname = os.path.dirname(self.cache_file)
                 if dirname:
                     os.makedirs(dirname, exist_ok=True)
-                with open(self.cache_file, 'wb') as f:
-                    pickle.dump(self.cache, f)
+                write_scan_cache(self.cache_file, self.cache)
             except Exception as e:
                 logger.warning(f"Failed to save cache '{self.cache_file}': {e}")
 
@@ -178,16 +366,17 @@ class IncrementalScanner:
 
             parsed_items = []
             for item in items:
-                parts = item.split(';')
-                name = parts[-1].strip()
+                # "fact=val;fact=val; name" : un seul partition par fact
+                facts, _, name = item.partition(' ')
+                name = name.strip()
 
                 if name in ('.', '..'):
                     continue
 
                 props = {}
-                for part in parts[:-1]:
-                    if '=' in part:
-                        key, value = part.split('=', 1)
+                for part in facts.split(';'):
+                    key, sep, value = part.partition('=')
+                    if sep:
                         props[key] = value
                 
                 # Détecter les symlinks (type=lnk) et les skipper
@@ -290,7 +479,9 @@ class IncrementalScanner:
         Scan récursif d'un dossier avec reconnection automatique
         """
         files = {}
-        current_path = os.path.join(base_path, relative_path).replace('\\', '/')
+        # Chemins FTP toujours en '/' : concaténation, sans os.path.join + replace
+        current_path = base_path.rstrip('/') + '/' + relative_path
+        prefix = relative_path + '/' if relative_path else ''
 
         self.scan_stats['dirs_scanned'] += 1
 
@@ -305,7 +496,7 @@ class IncrementalScanner:
             return files
 
         for name, props in items:
-            rel_path = os.path.join(relative_path, name).replace('\\', '/')
+            rel_path = prefix + name
 
             if props.get('type') == 'dir':
                 # Récursion dans les sous-dossiers
@@ -315,7 +506,7 @@ class IncrementalScanner:
                 # Fichier
                 files[rel_path] = {
                     'size': int(props.get('size', 0)),
-                    'modify': props.get('modify', ''),
+                    'modify': sys.intern(props.get('modify', '')),
                 }
                 self.scan_stats['files_found'] += 1
 
@@ -389,7 +580,7 @@ class IncrementalScanner:
         # Mais beaucoup de serveurs FTP ne supportent pas MDTM sur les dossiers
         # Donc on fait un compromis : scanner tous les dossiers de premier niveau
 
-        files = dict(self.cache.files)  # Copier le cache
+        files = dict(self.cache.files.items())  # Copier le cache (parcours séquentiel)
 
         # Scanner les nouveaux dossiers et mettre à jour les fichiers root
         for name, props in root_items:
@@ -407,7 +598,7 @@ class IncrementalScanner:
                 # Fichier à la racine
                 files[rel_path] = {
                     'size': int(props.get('size', 0)),
-                    'modify': props.get('modify', ''),
+                    'modify': sys.intern(props.get('modify', '')),
                 }
                 self.scan_stats['files_found'] += 1
 
@@ -619,101 +810,44 @@ class IncrementalScanner:
                 logger.warning("scan_ssh_find: could not resolve real path")
                 return None
 
-            # Use find with -printf for efficient output (GNU find)
-            # %P = relative path, %s = size in bytes, %T@ = mtime as epoch seconds
-            cmd = f'find -L "{real_root}" -type f -printf "%P\\t%s\\t%T@\\n"'
-            logger.info(f"SSH find scan: {cmd}")
-
-            stdin, stdout, stderr = ssh_client.exec_command(cmd, timeout=3600)
+            # Une seule commande find pour tout l'arbre (taille + mtime en flux)
+            logger.info(f"SSH find scan: {real_root}")
 
             files = {}
-            line_buffer = b''
-            bytes_read = 0
-
-            # Stream output line by line to handle 400K+ files without issues
-            while True:
-                chunk = stdout.read(65536)
-                if not chunk:
-                    break
-                bytes_read += len(chunk)
-                line_buffer += chunk
-
-                # Process complete lines
-                while b'\n' in line_buffer:
-                    line_bytes, line_buffer = line_buffer.split(b'\n', 1)
-                    line = line_bytes.decode('utf-8', errors='replace').strip()
-                    if not line:
-                        continue
-
-                    parts = line.split('\t', 2)
-                    if len(parts) != 3:
-                        continue
-
-                    rel_path, size_str, mtime_str = parts
+            find_errors = []
 
-                    # Skip empty relative path (the root directory itself)
-                    if not rel_path:
-                        continue
-
-                    # Normalize path separators
-                    rel_path = rel_path.replace('\\', '/')
-
-                    try:
-                        size = int(size_str)
-                    except ValueError:
-                        size = 0
+            # Une seule chaîne par seconde distincte (formatage + mémoire partagée)
+            modify_cache = {}
 
-                    # Convert epoch timestamp to MLSD format (YYYYMMDDHHMMSS)
+            def format_mtime(epoch):
+                modify = modify_cache.get(epoch)
+                if modify is None:
                     try:
-                        epoch = float(mtime_str)
-                        modify = datetime.fromtimestamp(epoch).strftime('%Y%m%d%H%M%S')
-                    except (ValueError, OSError):
+                        modify = datetime.fromtimestamp(epoch).strftime('%Y%m%d%H%M%S') if epoch is not None else ''
+                    except (ValueError, OSError, OverflowError):
                         modify = ''
+                    modify_cache[epoch] = modify
+                return modify
 
+            try:
+                for rel_path, size, mtime in bulk_remote_stat(ssh_client, real_root, errors=find_errors):
                     files[rel_path] = {
                         'size': size,
-                        'modify': modify,
+                        'modify': format_mtime(mtime),
                     }
                     self.scan_stats['files_found'] += 1
 
                     # Progress callback every 5000 files
                     if status_callback and self.scan_stats['files_found'] % 5000 == 0:
                         status_callback(self.scan_stats)
-
-            # Process any remaining data in buffer
-            if line_buffer:
-                line = line_buffer.decode('utf-8', errors='replace').strip()
-                if line:
-                    parts = line.split('\t', 2)
-                    if len(parts) == 3:
-                        rel_path, size_str, mtime_str = parts
-                        if rel_path:
-                            rel_path = rel_path.replace('\\', '/')
-                            try:
-                                size = int(size_str)
-                            except ValueError:
-                                size = 0
-                            try:
-                                epoch = float(mtime_str)
-                                modify = datetime.fromtimestamp(epoch).strftime('%Y%m%d%H%M%S')
-                            except (ValueError, OSError):
-                                modify = ''
-                            files[rel_path] = {'size': size, 'modify': modify}
-                            self.scan_stats['files_found'] += 1
-
-            # Check for errors (e.g., find: -printf not supported)
-            exit_code = stdout.channel.recv_exit_status()
-            err_output = stderr.read().decode('utf-8', errors='replace').strip()
-
-            if exit_code != 0 and not files:
+            except RuntimeError as e:
                 # find command failed entirely (maybe -printf not supported)
-                logger.warning(f"SSH find failed (exit {exit_code}): {err_output}")
+                logger.warning(f"SSH {e}")
                 return None
 
-            if err_output:
+            if find_errors:
                 # Log warnings but don't fail (permission denied on some dirs is OK)
-                error_lines = err_output.splitlines()
-                real_errors = [l for l in error_lines if 'Permission denied' not in l]
+                real_errors = [l for l in find_errors if 'Permission denied' not in l]
                 if real_errors:
                     for line in real_errors[:5]:
                         logger.warning(f"find: {line}")
@@ -793,7 +927,8 @@ class ChunkedScanner:
         def process_directory(dir_path, relative_path=''):
             nonlocal chunk_num, current_chunk
 
-            full_path = os.path.join(dir_path, relative_path).replace('\\', '/')
+            full_path = dir_path.rstrip('/') + '/' + relative_path
+            prefix = relative_path + '/' if relative_path else ''
 
             try:
                 self.ftp.cwd(full_path)
@@ -801,21 +936,34 @@ class ChunkedScanner:
                 self.ftp.retrlines('MLSD', items.append)
 
                 for item in items:
-                    parts = item.split(';')
-                    name = parts[-1].strip()
+                    facts, _, name = item.partition(' ')
+                    name = name.strip()
 
                     if name in ('.', '..'):
                         continue
 
-                    props = {p.split('=')[0]: p.split('=')[1] for p in parts[:-1] if '=' in p}
-                    rel_path = os.path.join(relative_path, name).replace('\\', '/')
+                    # Seuls type/size/modify sont lus : pas de dict intermédiaire
+                    entry_type = size = modify = None
+                    for fact in facts.split(';'):
+                        key, _, value = fact.partition('=')
+                        if key == 'type':
+                            entry_type = value
+                        elif key == 'size':
+                            size = value
+                        elif key == 'modify':
+                            modify = value
+
+                    if entry_type in ('cdir', 'pdir'):
+                        continue
+
+                    rel_path = prefix + name
 
-                    if props.get('type') == 'dir':
+                    if entry_type == 'dir':
                         process_directory(dir_path, rel_path)
                     else:
                         current_chunk[rel_path] = {
-                            'size': int(props.get('size', 0)),
-                            'modify': props.get('modify', ''),
+                            'size': int(size or 0),
+                            'modify': sys.intern(modify or ''),
                         }
 
                         # Si chunk plein, appeler le callback
@@ -0,0 +1,85 @@
+"""
+Linux Optimized - Métadonnées locales via statx()
+Taille + mtime + type uniquement, sans forcer de resynchronisation
+avec le serveur de fichiers (partages NFS/CIFS du NAS)
+"""
+
+import os
+import sys
+import ctypes
+import struct
+import errno
+import platform
+import logging
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+# Numéro de l'appel système statx selon l'architecture
+_SYS_STATX = {
+    'x86_64': 332,
+    'aarch64': 291,
+    'riscv64': 291,
+    'i386': 383,
+    'i686': 383,
+    'armv7l': 397,
+    'ppc64le': 383,
+    's390x': 379,
+}.get(platform.machine())
+
+_AT_FDCWD = -100
+# Attributs en cache acceptés : pas d'aller-retour GETATTR sur un montage réseau
+_AT_STATX_DONT_SYNC = 0x4000
+_STATX_TYPE = 0x0001
+_STATX_MTIME = 0x0040
+_STATX_SIZE = 0x0200
+_STATX_MASK = _STATX_TYPE | _STATX_MTIME | _STATX_SIZE
+
+# struct statx (256 octets) : stx_mode à 28, stx_size à 40, stx_mtime (sec, nsec) à 112
+_STATX_BUFFER_SIZE = 256
+_MODE = struct.Struct('=H')
+_SIZE = struct.Struct('=Q')
+_MTIME = struct.Struct('=qI')
+
+# Résolu au premier appel : None = pas encore testé, False = indisponible
+_syscall = None
+
+
+def _load_syscall():
+    """libc.syscall si statx est utilisable ici (Linux, architecture connue)"""
+    if not sys.platform.startswith('linux') or _SYS_STATX is None:
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.syscall
+    except (OSError, AttributeError):
+        return False
+
+
+def stat_light(path: str) -> Tuple[int, int, int]:
+    """
+    (size, mtime_ns, mode) d'un fichier local, via statx() avec
+    AT_STATX_DONT_SYNC et le masque minimal (type, taille, mtime).
+    Retombe sur os.stat si statx n'est pas disponible (noyau < 4.11,
+    seccomp, autre OS). Lève OSError comme os.stat.
+    """
+    global _syscall
+    if _syscall is None:
+        _syscall = _load_syscall()
+
+    if _syscall:
+        encoded = os.fsencode(path)
+        buf = ctypes.create_string_buffer(_STATX_BUFFER_SIZE)
+        if _syscall(_SYS_STATX, _AT_FDCWD, encoded, _AT_STATX_DONT_SYNC, _STATX_MASK, buf) == 0:
+            sec, nsec = _MTIME.unpack_from(buf, 112)
+            return _SIZE.unpack_from(buf, 40)[0], sec * 1_000_000_000 + nsec, _MODE.unpack_from(buf, 28)[0]
+
+        err = ctypes.get_errno()
+        if err not in (errno.ENOSYS, errno.EPERM):
+            raise OSError(err, os.strerror(err), path)
+        # Appel système refusé ou absent : os.stat pour la suite du processus
+        logger.debug(f"statx unavailable ({os.strerror(err)}), using os.stat")
+        _syscall = False
+
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_mode
@@ -4,6 +4,7 @@ Optimisé pour télécharger des milliers de fichiers en parallèle
 """
 
 import os
+import sys
 import queue
 import threading
 import logging
@@ -13,17 +14,27 @@ from typing import List, Callable, Optional, Dict
 from datetime import datetime
 import time
 from modules.sftp_adapter import SFTPAdapter
+from modules.linux_optimized import stat_light
+from modules.core import (
+    TunedFTP, FTP_SOCKET_BUFFER, TRANSFER_BLOCKSIZE, SFTP_WINDOW_SIZE, SFTP_MAX_PACKET_SIZE
+)
 from modules.checksum_utils import (
     calculate_file_hash,
-    calculate_remote_hash,
+    calculate_remote_hashes,
+    hash_batch,
+    remote_hash_timeout,
+    size_tolerance,
     verify_download_integrity,
     get_remote_file_info
 )
 
 logger = logging.getLogger(__name__)
 
+# Une instance par fichier : sans __dict__ par objet (slots) quand Python le permet (3.10+)
+_DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
 
-@dataclass
+@dataclass(**_DATACLASS_SLOTS)
 class DownloadTask:
     """Représente une tâche de téléchargement"""
     rel_path: str
@@ -37,7 +48,7 @@ class DownloadTask:
         return self.priority < other.priority
 
 
-@dataclass
+@dataclass(**_DATACLASS_SLOTS)
 class DownloadResult:
     """Résultat d'un téléchargement"""
     rel_path: str
@@ -70,14 +81,18 @@ class ParallelDownloader:
                  max_retries: int = 3,
                  verify_integrity: bool = True,
                  use_hash_verification: bool = False,
-                 hash_algorithm: str = 'md5'):
+                 hash_algorithm: str = 'md5',
+                 shared_ssh: Optional[SFTPAdapter] = None):
         """
         Args:
             num_workers: Nombre de connexions FTP simultanées
             max_retries: Nombre de tentatives par fichier
             verify_integrity: Vérifier la taille après download
-            use_hash_verification: Utiliser hash MD5/SHA pour vérification (plus fiable)
+            use_hash_verification: Comparer aussi le hash MD5/SHA des fichiers téléchargés
+                                   avec celui du serveur (SFTP, vérifié par lot en fin de file)
             hash_algorithm: Algorithme de hash (md5, sha1, sha256)
+            shared_ssh: Connexion SFTP déjà ouverte ; les workers ouvrent leur canal
+                        sur son transport au lieu de refaire une connexion SSH
         """
         self.ftp_host = ftp_host
         self.ftp_port = ftp_port
@@ -88,6 +103,7 @@ class ParallelDownloader:
         self.verify_integrity = verify_integrity
         self.use_hash_verification = use_hash_verification
         self.hash_algorithm = hash_algorithm
+        self.shared_ssh = shared_ssh
 
         # Queues
         self.task_queue = queue.PriorityQueue()
@@ -114,15 +130,27 @@ class ParallelDownloader:
         self._created_dirs = set()
         self._dirs_lock = threading.Lock()
 
+        # Téléchargements réussis dont le hash reste à vérifier : [(task, result)]
+        # (protégé par stats_lock, vidé par _verify_pending_hashes)
+        self._hash_pending = []
+
     def _create_ftp_connection(self) -> FTP:
         """Crée une nouvelle connexion FTP/SFTP avec retry"""
+        if self.shared_ssh is not None:
+            try:
+                return self.shared_ssh.open_session()
+            except Exception as e:
+                # Transport partagé perdu : connexion dédiée
+                logger.debug(f"Shared SSH transport unavailable ({e}), opening a new connection")
+
         max_connect_retries = 3
         for attempt in range(max_connect_retries):
             try:
                 if self.ftp_port == 22:
-                    ftp = SFTPAdapter(timeout=300)
+                    ftp = SFTPAdapter(timeout=300, window_size=SFTP_WINDOW_SIZE or None,
+                                      max_packet_size=SFTP_MAX_PACKET_SIZE or None)
                 else:
-                    ftp = FTP(timeout=300)
+                    ftp = TunedFTP(timeout=300, rcvbuf=FTP_SOCKET_BUFFER)
 
                 ftp.connect(self.ftp_host, self.ftp_port)
                 ftp.login(self.ftp_user, self.ftp_pass)
@@ -214,8 +242,11 @@ class ParallelDownloader:
                     elif result.success:
                         consecutive_errors = 0
 
-                    # Envoyer le résultat
-                    self.result_queue.put(result)
+                    # Envoyer le résultat (sauf succès en attente de la vérification
+                    # des hash par lot : _verify_pending_hashes le publiera)
+                    if not (result.success and result.error_message is None
+                            and self._defers_hash(task)):
+                        self.result_queue.put(result)
 
                     # Retry si échec (requeue)
                     if not result.success and task.retry_count < self.max_retries:
@@ -274,45 +305,35 @@ class ParallelDownloader:
         with self._dirs_lock:
             self._created_dirs.add(dir_path)
 
+    def _defers_hash(self, task: DownloadTask) -> bool:
+        """Le hash de ce fichier est-il vérifié par lot (_verify_pending_hashes) ?"""
+        return (self.verify_integrity and self.use_hash_verification and self.hash_algorithm
+                and self._is_sftp and task.size > 0)
+
     def _verify_download(self, ftp, task: DownloadTask, local_path: str, start_time: float) -> tuple:
         """
         Vérifie l'intégrité du fichier téléchargé.
         
         Strategy:
-        1. Si hash verification activé et SSH dispo: vérifier via hash distant
-        2. Sinon: vérification taille avec tolérance
-        3. En cas d'échec: smart retry avec re-scan du fichier
+        1. Vérification taille avec tolérance
+        2. En cas d'échec: smart retry avec re-scan du fichier
+        Le hash (use_hash_verification) est vérifié ensuite, par lot, dans
+        _verify_pending_hashes : une commande SSH pour tous les fichiers.
         
         Returns:
             (success: bool, message: str, new_size: int or None)
         """
-        # Récupérer le client SSH si disponible (pour hash verification)
+        # Récupérer le client SSH si disponible (pour le smart retry)
         ssh = None
         sftp = None
         if self._is_sftp and hasattr(ftp, 'ssh'):
             ssh = ftp.ssh
             sftp = ftp.sftp
         
-        # === Option 1: Hash verification (si activé et SSH dispo) ===
-        if self.use_hash_verification and ssh and self.hash_algorithm:
-            # Calculer hash distant
-            remote_hash = calculate_remote_hash(ssh, task.remote_path, self.hash_algorithm)
-            if remote_hash:
-                # Comparer avec hash local
-                local_hash = calculate_file_hash(local_path, self.hash_algorithm)
-                if local_hash and local_hash.lower() == remote_hash.lower():
-                    return True, f"Hash verified ({self.hash_algorithm})", None
-                
-                # Hash mismatch: fichier corrompu ou différent
-                logger.debug(f"Hash mismatch for {task.rel_path}: remote={remote_hash}, local={local_hash}")
-                return False, f"Hash mismatch: remote={remote_hash}, local={local_hash}", None
-            else:
-                logger.debug(f"Remote hash not available for {task.rel_path}, falling back to size")
-        
-        # === Option 2: Size verification avec tolérance ===
+        # === Size verification avec tolérance ===
         if task.size > 0:
-            actual_size = os.path.getsize(local_path)
-            tolerance = max(int(task.size * 0.001), 10)  # 0.1% ou minimum 10 bytes
+            actual_size = stat_light(local_path)[0]
+            tolerance = size_tolerance(task.size)  # 0.1% ou minimum 10 bytes
             
             if abs(actual_size - task.size) <= tolerance:
                 return True, f"Size verified (tolerance: {tolerance} bytes)", actual_size
@@ -411,8 +432,9 @@ class ParallelDownloader:
             if self._is_sftp and hasattr(ftp, 'download_file'):
                 ftp.download_file(task.remote_path, task.local_path)
             else:
-                with open(task.local_path, 'wb') as f:
-                    ftp.retrbinary(f"RETR {task.remote_path}", f.write)
+                # Blocs de 1 MB : un recv() et un write() par Mo au lieu d'un par 8 KB
+                with open(task.local_path, 'wb', buffering=TRANSFER_BLOCKSIZE) as f:
+                    ftp.retrbinary(f"RETR {task.remote_path}", f.write, blocksize=TRANSFER_BLOCKSIZE)
 
             # Vérification d'intégrité avec hash + smart retry
             if self.verify_integrity and task.size > 0:
@@ -443,12 +465,7 @@ class ParallelDownloader:
 
             # Succès
             duration = time.time() - start_time
-
-            with self.stats_lock:
-                self.stats['completed'] += 1
-                self.stats['bytes_transferred'] += actual_size
-
-            return DownloadResult(
+            result = DownloadResult(
                 rel_path=task.rel_path,
                 success=True,
                 size=actual_size,
@@ -456,6 +473,16 @@ class ParallelDownloader:
                 retry_count=task.retry_count
             )
 
+            with self.stats_lock:
+                self.stats['completed'] += 1
+                self.stats['bytes_transferred'] += actual_size
+                # Même verrou que le compteur : wait_completion ne peut pas voir
+                # le fichier terminé sans le trouver dans la liste d'attente
+                if self._defers_hash(task):
+                    self._hash_pending.append((task, result))
+
+            return result
+
         except Exception as e:
             # Clean up partial file
             try:
@@ -544,13 +571,17 @@ class ParallelDownloader:
                 progress_callback(completed, total, self.get_statistics())
                 last_progress_time = time.time()
 
-            # Vérifier si terminé
+            # Vérifier si terminé (les fichiers au hash faux repartent en file)
             if completed >= total and self.task_queue.empty():
+                if self._verify_pending_hashes():
+                    last_completed = 0  # fichiers remis en file : le compteur a reculé
+                    continue
                 break
 
             # Stall detection
             if time.time() - last_progress_change > stall_timeout:
                 logger.warning("Download appears stalled, stopping workers...")
+                self._verify_pending_hashes(requeue=False)
                 break
 
             time.sleep(0.2)
@@ -561,6 +592,80 @@ class ParallelDownloader:
                             self.stats['total_files'],
                             self.get_statistics())
 
+    def _verify_pending_hashes(self, requeue: bool = True) -> int:
+        """
+        Vérifie par lot le hash des fichiers téléchargés : tous les hash
+        distants en une commande SSH (calculate_remote_hashes), comparés aux
+        hash locaux calculés sur tous les cœurs (hash_batch). Un fichier sans hash côté serveur garde la vérification
+        de taille. Un fichier corrompu est supprimé et, si requeue et qu'il
+        reste des tentatives, remis en file.
+        
+        Returns:
+            Nombre de fichiers remis en file
+        """
+        with self.stats_lock:
+            pending, self._hash_pending = self._hash_pending, []
+        if not pending:
+            return 0
+
+        remote_hashes = {}
+        conn = None
+        try:
+            conn = self._create_ftp_connection()
+            remote_hashes = calculate_remote_hashes(
+                conn.ssh, [task.remote_path for task, result in pending], self.hash_algorithm,
+                timeout=remote_hash_timeout(max(task.size for task, result in pending), minimum=300)
+            )
+        except Exception as e:
+            logger.warning(f"Batched hash verification unavailable, size checks kept: {e}")
+        finally:
+            self._close_connection(conn)
+
+        # Hash locaux en parallèle, seulement là où le serveur a répondu
+        local_hashes = hash_batch(
+            (task.local_path for task, result in pending if task.remote_path in remote_hashes),
+            self.hash_algorithm
+        )
+
+        requeued = 0
+        for task, result in pending:
+            remote_hash = remote_hashes.get(task.remote_path)
+            if remote_hash is None:
+                self.result_queue.put(result)
+                continue
+
+            local_hash = local_hashes.get(task.local_path)
+            if local_hash and local_hash.lower() == remote_hash:
+                self.result_queue.put(result)
+                continue
+
+            # Hash mismatch: fichier corrompu ou modifié pendant le transfert
+            logger.debug(f"Hash mismatch for {task.rel_path}: remote={remote_hash}, local={local_hash}")
+            try:
+                os.remove(task.local_path)
+            except OSError:
+                pass
+            self.result_queue.put(DownloadResult(
+                rel_path=task.rel_path,
+                success=False,
+                size=0,
+                duration=result.duration,
+                error_message=f"Hash mismatch: remote={remote_hash}, local={local_hash}",
+                retry_count=task.retry_count
+            ))
+
+            with self.stats_lock:
+                self.stats['completed'] -= 1
+                self.stats['bytes_transferred'] -= result.size
+                if not (requeue and task.retry_count < self.max_retries):
+                    self.stats['failed'] += 1
+            if requeue and task.retry_count < self.max_retries:
+                task.retry_count += 1
+                self.task_queue.put((task.priority + 100, task))
+                requeued += 1
+
+        return requeued
+
     def get_statistics(self) -> Dict:
         """Récupère les statistiques actuelles"""
         with self.stats_lock:
@@ -627,6 +732,33 @@ class DownloadOrganizer:
 
         return result
 
+    @staticmethod
+    def hybrid_order(rel_paths, sizes, threshold: int = 1024 * 1024) -> List[int]:
+        """
+        Ordre hybride calculé sur des colonnes parallèles (chemins, tailles) :
+        retourne la permutation des indices, sans créer de DownloadTask.
+        - Petits fichiers d'abord, groupés par dossier (ordre d'entrée conservé)
+        - Puis gros fichiers, du plus gros au plus petit
+        """
+        dirname = os.path.dirname
+        # Dossier de chaque petit fichier (None : gros fichier)
+        dirs = [dirname(rel_path) if size <= threshold else None
+                for rel_path, size in zip(rel_paths, sizes)]
+        small_dirs = set(dirs)
+        small_dirs.discard(None)
+        dir_rank = {d: rank for rank, d in enumerate(sorted(small_dirs))}
+        
+        # Clé entière composite (un int se compare bien plus vite qu'un tuple) :
+        # rang du dossier pour les petits fichiers ; au-delà de tous les rangs,
+        # les gros fichiers par taille décroissante
+        base = len(dir_rank)
+        largest = max(sizes, default=0)
+        keys = [dir_rank[d] if d is not None else base + largest - size
+                for d, size in zip(dirs, sizes)]
+        del dirs
+        # Un seul tri stable des indices (clés précalculées, pas de lambda)
+        return sorted(range(len(keys)), key=keys.__getitem__)
+
     @staticmethod
     def prioritize_hybrid(tasks: List[DownloadTask]) -> List[DownloadTask]:
         """
@@ -634,25 +766,14 @@ class DownloadOrganizer:
         - Petits fichiers d'abord (feedback rapide)
         - Groupés par dossier (efficacité FTP)
         """
-        # Séparer petits et gros fichiers
-        threshold = 1024 * 1024  # 1 MB
-        small_files = [t for t in tasks if t.size <= threshold]
-        large_files = [t for t in tasks if t.size > threshold]
-
-        # Petits fichiers par dossier
-        small_by_dir = DownloadOrganizer.prioritize_by_directory(small_files)
+        order = DownloadOrganizer.hybrid_order(
+            [t.rel_path for t in tasks], [t.size for t in tasks]
+        )
 
-        # Gros fichiers par taille
-        large_by_size = DownloadOrganizer.prioritize_by_size(large_files, small_first=False)
-
-        # Combiner : petits d'abord, puis gros
-        priority = 0
-        for task in small_by_dir:
-            task.priority = priority
-            priority += 1
-
-        for task in large_by_size:
+        result = []
+        for priority, idx in enumerate(order):
+            task = tasks[idx]
             task.priority = priority
-            priority += 1
+            result.append(task)
 
-        return small_by_dir + large_by_size
+        return result
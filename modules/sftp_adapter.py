@@ -25,8 +25,11 @@ class SFTPAdapter:
     Adapter to make paramiko.SFTPClient look like ftplib.FTP.
     This allows re-using existing FTP-based logic with SFTP.
     """
-    def __init__(self, timeout=300):
+    def __init__(self, timeout=300, window_size=None, max_packet_size=None):
         self.timeout = timeout
+        # Canal SFTP : None = valeurs par défaut de paramiko (fenêtre 2 MB, paquets 32 KB)
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
         self.ssh = None
         self.sftp = None
         self.host = None
@@ -34,6 +37,7 @@ class SFTPAdapter:
         self.user = None
         self.password = None
         self.welcome = "220 SFTP Ready"
+        self._owns_ssh = True  # False pour une session ouverte sur le transport d'une autre connexion
 
     def _log(self, msg, level=logging.DEBUG):
         logger.log(level, f"[SFTP] {msg}")
@@ -77,7 +81,10 @@ class SFTPAdapter:
                 self.ssh = paramiko.SSHClient()
                 self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
                 self.ssh.connect(self.host, port=self.port, username=self.user, password=self.password, timeout=self.timeout)
-                self.sftp = self.ssh.open_sftp()
+                self.sftp = paramiko.SFTPClient.from_transport(
+                    self.ssh.get_transport(),
+                    window_size=self.window_size, max_packet_size=self.max_packet_size
+                )
                 
                 cwd = self.sftp.getcwd()
                 self._log(f"SFTP Connected. Initial CWD: {cwd}", level=logging.INFO)
@@ -91,6 +98,27 @@ class SFTPAdapter:
                 else:
                     raise ConnectionError(f"Failed to connect to SFTP {self.host} after {max_retries} attempts: {e}")
 
+    def open_session(self):
+        """
+        Nouvelle connexion SFTP multiplexée sur le transport SSH existant :
+        un canal de plus, sans nouvelle poignée de main (KEX + auth).
+        Fermer la session ne ferme que son canal.
+        """
+        transport = self.ssh.get_transport() if self.ssh else None
+        if not transport or not transport.is_active():
+            raise ConnectionError("SSH transport is not active")
+
+        session = SFTPAdapter(timeout=self.timeout, window_size=self.window_size,
+                              max_packet_size=self.max_packet_size)
+        session.host, session.port = self.host, self.port
+        session.user, session.password = self.user, self.password
+        session.ssh = self.ssh
+        session.sftp = paramiko.SFTPClient.from_transport(
+            transport, window_size=self.window_size, max_packet_size=self.max_packet_size
+        )
+        session._owns_ssh = False
+        return session
+
     def cwd(self, path):
         try:
             self.sftp.chdir(path)
@@ -439,6 +467,20 @@ class SFTPAdapter:
         
         return "226 Transfer complete"
 
+    def mlsd(self, path="", facts=[]):
+        """
+        Mimics FTP.mlsd: yields (name, facts_dict) tuples
+        """
+        lines = []
+        self.retrlines(f"MLSD {path}" if path else "MLSD", lines.append)
+        for line in lines:
+            facts_found, _, name = line.partition(' ')
+            entry = {}
+            for fact in facts_found[:-1].split(";"):
+                key, _, value = fact.partition("=")
+                entry[key.lower()] = value
+            yield (name, entry)
+
     def sendcmd(self, cmd):
         """
         Handle MDTM and other simple commands
@@ -453,6 +495,9 @@ class SFTPAdapter:
         
         if cmd == 'TYPE I':
             return "200 Type set to I"
+        
+        if cmd.startswith('OPTS'):
+            return "200 OPTS ignored"
             
         raise NotImplementedError(f"Command {cmd} not implemented in SFTPAdapter")
 
@@ -468,7 +513,9 @@ class SFTPAdapter:
                 pass
             self.sftp = None
         
-        if self.ssh:
+        if self.ssh and not self._owns_ssh:
+            self.ssh = None
+        elif self.ssh:
             try:
                 self.ssh.close()
             except:
@@ -5,9 +5,103 @@ Replaces JSON files with SQLite for 1M+ files support
 
 import sqlite3
 import os
-from datetime import datetime
+import queue
+import logging
+import threading
+from array import array
+from datetime import datetime, timedelta
 from contextlib import contextmanager
-from typing import Dict, List, Set, Optional, Tuple
+from functools import lru_cache
+from itertools import chain, islice
+from typing import Dict, List, Set, Optional, Tuple, Iterable, Iterator
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+# Lignes par INSERT multi-VALUES : 4 paramètres par ligne, sous la limite de
+# variables SQLite (999 avant 3.32, 32766 ensuite)
+UPSERT_ROWS_PER_STATEMENT = 500 if sqlite3.sqlite_version_info >= (3, 32, 0) else 240
+
+
+@lru_cache(maxsize=8)
+def _upsert_sql(rows: int) -> str:
+    """
+    UPSERT de `rows` lignes en un seul statement. Peu de tailles distinctes
+    (taille pleine + reste) : le texte est construit une fois, et sqlite3
+    réutilise le statement préparé de son cache.
+    """
+    values = ','.join(["(?, ?, ?, ?, 'synced')"] * rows)
+    return f'''
+        INSERT INTO file_state (rel_path, size, modify, last_sync, status)
+        VALUES {values}
+        ON CONFLICT(rel_path) DO UPDATE SET
+            size = excluded.size,
+            modify = excluded.modify,
+            last_sync = excluded.last_sync,
+            status = 'synced'
+    '''
+
+
+@lru_cache(maxsize=8)
+def _scan_insert_sql(rows: int) -> str:
+    """INSERT multi-VALUES de `rows` lignes dans remote_scan (même principe que _upsert_sql)"""
+    values = ','.join(['(?, ?, ?)'] * rows)
+    return f'INSERT INTO remote_scan (rel_path, size, modify) VALUES {values}'
+
+
+_CHECKPOINT_SQL = '''
+    INSERT INTO sync_checkpoints 
+    (sync_id, timestamp, files_processed, files_total, bytes_transferred, status)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def iter_chunks(items: Iterable, size: int) -> Iterator[List]:
+    """Découpe un itérable en listes de `size` éléments sans le copier entièrement"""
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_json_state(f) -> Iterator[Tuple[str, int, str]]:
+    """
+    Lit un ancien fichier d'état JSON ({rel_path: {size, modify}}) ouvert en binaire
+    et produit des tuples (rel_path, size, modify).
+    Avec ijson, le fichier est parcouru en flux sans être chargé en mémoire.
+    """
+    if ijson:
+        entries = ijson.kvitems(f, '')
+    else:
+        import json
+        entries = json.load(f).items()
+    
+    for rel_path, info in entries:
+        yield rel_path, int(info['size']), info['modify']
+
+
+def remove_database(db_path: str):
+    """Supprime une base SQLite et ses fichiers annexes (-wal, -shm, -journal)"""
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        try:
+            os.remove(db_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+class _StateConnection(sqlite3.Connection):
+    """Connexion dont commit() est différé tant qu'une transaction englobante est ouverte"""
+    deferred = False
+    
+    def commit(self):
+        if not self.deferred:
+            super().commit()
 
 
 class StateManager:
@@ -18,11 +112,15 @@ class StateManager:
     
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self._tx = threading.local()  # connexion de la transaction() en cours, par thread
         self._init_database()
     
     def _init_database(self):
         """Initialise la base de données avec les tables et index nécessaires"""
         with self._get_connection() as conn:
+            # WAL : écritures en append, lecteurs non bloqués (persistant dans le fichier)
+            conn.execute('PRAGMA journal_mode=WAL')
+            
             cursor = conn.cursor()
             
             # Table principale pour l'état des fichiers
@@ -63,9 +161,30 @@ class StateManager:
                 )
             ''')
             
-            # Index pour les recherches rapides
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_rel_path ON file_state(rel_path)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_status ON file_state(status)')
+            # Table pour le cache des listings de dossiers distants
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS dir_state (
+                    rel_path TEXT PRIMARY KEY,
+                    modify TEXT NOT NULL,
+                    last_listed TEXT NOT NULL
+                )
+            ''')
+            
+            # Résultat du dernier scan distant (backup optimisé) : la comparaison
+            # se fait en SQL, sans garder le dict du scan en mémoire
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS remote_scan (
+                    rel_path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    modify TEXT NOT NULL
+                ) WITHOUT ROWID
+            ''')
+
+            # Index pour les recherches rapides. rel_path est déjà indexé par sa
+            # contrainte UNIQUE ; idx_rel_path (une 2e copie de chaque chemin) et
+            # idx_status (jamais interrogé) ne faisaient qu'alourdir base et écritures
+            cursor.execute('DROP INDEX IF EXISTS idx_rel_path')
+            cursor.execute('DROP INDEX IF EXISTS idx_status')
             cursor.execute('CREATE INDEX IF NOT EXISTS idx_sync_id ON sync_checkpoints(sync_id)')
             
             conn.commit()
@@ -73,13 +192,63 @@ class StateManager:
     @contextmanager
     def _get_connection(self):
         """Context manager pour les connexions SQLite"""
-        conn = sqlite3.connect(self.db_path)
+        tx_conn = getattr(self._tx, 'conn', None)
+        if tx_conn is not None:
+            # Dans une transaction() : même connexion, commit au COMMIT final
+            yield tx_conn
+            return
+        
+        conn = sqlite3.connect(self.db_path, factory=_StateConnection)
         conn.row_factory = sqlite3.Row
+        # Réglages par connexion (journal_mode=WAL est persistant, posé à l'init)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-65536')  # 64 MB
+        conn.execute('PRAGMA mmap_size=268435456')  # lectures mappées (256 MB max)
+        # Checkpoint automatique tous les 10000 pages (~40 MB) au lieu de 1000 :
+        # pas d'arrêt en cours de synchro, les checkpoints explicites se font aux phases
+        conn.execute('PRAGMA wal_autocheckpoint=10000')
         try:
             yield conn
         finally:
             conn.close()
     
+    @contextmanager
+    def transaction(self, bulk: bool = False):
+        """
+        Regroupe plusieurs appels d'écriture dans une seule transaction
+        (BEGIN IMMEDIATE … COMMIT) : un seul fsync au lieu d'un par appel.
+        Les commit() des méthodes appelées à l'intérieur sont différés.
+        
+        bulk=True (chargement d'une base neuve, la source restant disponible) :
+        journal et synchronisation désactivés le temps du chargement, puis WAL
+        rétabli. Un échec laisse alors la base dans un état indéfini.
+        """
+        if getattr(self._tx, 'conn', None) is not None:
+            yield self  # déjà dans une transaction : on s'y joint
+            return
+        
+        with self._get_connection() as conn:
+            if bulk:
+                conn.execute('PRAGMA journal_mode=OFF')
+                conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('BEGIN IMMEDIATE')
+            conn.deferred = True
+            self._tx.conn = conn
+            try:
+                yield self
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.deferred = False
+                conn.commit()
+            finally:
+                conn.deferred = False
+                self._tx.conn = None
+                if bulk:
+                    conn.execute('PRAGMA journal_mode=WAL')
+    
     def get_file_state(self, rel_path: str) -> Optional[Dict]:
         """Récupère l'état d'un fichier spécifique"""
         with self._get_connection() as conn:
@@ -93,6 +262,16 @@ class StateManager:
                 return dict(row)
             return None
     
+    def get_file_states(self, paths: List[str], batch_size: int = 500) -> Dict[str, Dict]:
+        """Récupère l'état de plusieurs fichiers (une requête IN par groupe de chemins)"""
+        states = {}
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            for chunk in iter_chunks(paths, batch_size):
+                for rel_path, (size, modify) in self._fetch_states(cursor, chunk).items():
+                    states[rel_path] = {'size': size, 'modify': modify}
+        return states
+    
     def get_all_files(self) -> Dict[str, Dict]:
         """Récupère tous les fichiers (optimisé avec streaming)"""
         files = {}
@@ -120,90 +299,348 @@ class StateManager:
         with self._get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT rel_path FROM file_state')
-            return {row['rel_path'] for row in cursor.fetchall()}
+            return {row['rel_path'] for row in cursor}
     
+    @staticmethod
+    def _fetch_states(cursor, paths: List[str]) -> Dict[str, Tuple[int, str]]:
+        """Une seule requête IN pour un groupe de chemins: {rel_path: (size, modify)}"""
+        placeholders = ','.join('?' * len(paths))
+        cursor.execute(
+            f'SELECT rel_path, size, modify FROM file_state WHERE rel_path IN ({placeholders})',
+            paths
+        )
+        return {row['rel_path']: (row['size'], row['modify']) for row in cursor.fetchall()}
+
+    @classmethod
+    def _changed_in_chunk(cls, cursor, chunk: List[Tuple[str, Dict]]) -> List[str]:
+        """Chemins du chunk absents de la base ou dont size/modify diffèrent"""
+        existing = cls._fetch_states(cursor, [rel_path for rel_path, _ in chunk])
+
+        return [
+            rel_path for rel_path, info in chunk
+            if existing.get(rel_path) != (info['size'], info['modify'])
+        ]
+
+    def needs_update_batch(self, infos: Dict[str, Dict], batch_size: int = 500) -> Set[str]:
+        """
+        Retourne les chemins de `infos` qui nécessitent un transfert,
+        via une requête indexée par chunk (l'état complet n'est jamais chargé)
+        """
+        changed = set()
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            for chunk in iter_chunks(infos.items(), batch_size):
+                changed.update(self._changed_in_chunk(cursor, chunk))
+        return changed
+
     def find_files_to_download(self, remote_files: Dict[str, Dict], batch_size: int = 5000):
         """
         Compare remote files against SQLite state without loading all state into memory.
-        Returns (files_to_download, deleted_files) where:
+        Returns (files_to_download, total_bytes, deleted_files) where:
           - files_to_download: list of (rel_path, size) tuples
-          - deleted_files: set of rel_paths that exist in DB but not in remote
+          - deleted_files: sorted list of rel_paths that exist in DB but not in remote
+            (produit par la même passe : pas de différence d'ensembles séparée)
+        
+        Merge-join : les chemins distants triés sont comparés à un seul parcours
+        ordonné de la table (index rel_path), au lieu de requêtes IN + un
+        second parcours complet pour les suppressions.
         """
         files_to_download = []
         total_bytes = 0
-        remote_paths = set(remote_files.keys())
-        remote_list = list(remote_files.items())
+        deleted_files = []
+        
+        # L'ordre des str Python (code points) est celui de la collation BINARY (UTF-8).
+        # Colonnes parallèles (SoA) dans l'ordre trié : chemins, tailles en
+        # array('q') non boxées, dates ; pas de tuple par fichier
+        paths = sorted(remote_files)
+        infos = [remote_files[rel_path] for rel_path in paths]
+        sizes = array('q', [info['size'] for info in infos])
+        modifies = [info['modify'] for info in infos]
+        del infos
+        total = len(paths)
+        i = 0
 
         with self._get_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = None  # tuples bruts : plus rapide que sqlite3.Row
+            cursor.execute('SELECT rel_path, size, modify FROM file_state ORDER BY rel_path')
 
-            # Check remote files against DB in batches
-            for i in range(0, len(remote_list), batch_size):
-                batch = remote_list[i:i + batch_size]
-                paths = [p for p, _ in batch]
-                placeholders = ','.join('?' * len(paths))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                
+                # Boucle de comparaison laissée en Python : sur 1M de lignes elle
+                # pèse ~0,12 s contre ~1 s pour matérialiser les lignes (fetchmany),
+                # une extension compilée ne gagnerait que sur la plus petite part
+                for db_path, db_size, db_modify in rows:
+                    # Chemins distants absents de la base : nouveaux fichiers
+                    while i < total and paths[i] < db_path:
+                        files_to_download.append((paths[i], sizes[i]))
+                        total_bytes += sizes[i]
+                        i += 1
+                    
+                    if i < total and paths[i] == db_path:
+                        size = sizes[i]
+                        if size != db_size or modifies[i] != db_modify:
+                            files_to_download.append((db_path, size))
+                            total_bytes += size
+                        i += 1
+                    else:
+                        # En base mais plus sur le serveur
+                        deleted_files.append(db_path)
 
-                cursor.execute(
-                    f'SELECT rel_path, size, modify FROM file_state WHERE rel_path IN ({placeholders})',
-                    paths
-                )
-                existing = {row['rel_path']: row for row in cursor.fetchall()}
+        # Reste : chemins après la dernière ligne de la base
+        for j in range(i, total):
+            files_to_download.append((paths[j], sizes[j]))
+            total_bytes += sizes[j]
 
-                for rel_path, info in batch:
-                    row = existing.get(rel_path)
-                    if row is None or row['size'] != info['size'] or row['modify'] != info['modify']:
-                        files_to_download.append((rel_path, info['size']))
-                        total_bytes += info['size']
+        return files_to_download, total_bytes, deleted_files
 
-            # Find deleted files: in DB but not in remote
-            cursor.execute('SELECT rel_path FROM file_state')
-            deleted_files = set()
+    def load_remote_scan(self, remote_files, exclude=None) -> int:
+        """
+        Remplace le contenu de remote_scan par le résultat d'un scan distant.
+        L'appelant peut ensuite libérer son dict : la suite se fait en SQL.
+        Insertion par statements multi-VALUES, paramètres aplatis sans tuple par fichier.
+        
+        Args:
+            remote_files: {rel_path: {'size': ..., 'modify': ...}} ou itérable
+                          de tuples (rel_path, size, modify) (lu en flux)
+            exclude: prédicat sur rel_path ; les chemins exclus sont écartés
+                     pendant le chargement (même passe)
+        
+        Returns:
+            Nombre de fichiers chargés (exclus non compris)
+        """
+        is_dict = hasattr(remote_files, 'items')
+        count = 0
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM remote_scan')
+            
+            for batch in iter_chunks(remote_files.items() if is_dict else remote_files,
+                                     UPSERT_ROWS_PER_STATEMENT):
+                if exclude is not None:
+                    batch = [entry for entry in batch if not exclude(entry[0])]
+                    if not batch:
+                        continue
+                if is_dict:
+                    params = []
+                    for rel_path, info in batch:
+                        params += (rel_path, info['size'], info['modify'])
+                else:
+                    params = list(chain.from_iterable(batch))
+                cursor.execute(_scan_insert_sql(len(batch)), params)
+                count += len(batch)
+            
+            conn.commit()
+        
+        return count
+
+    def find_files_to_download_scan(self, batch_size: int = 5000):
+        """
+        Équivalent de find_files_to_download sur la table remote_scan :
+        jointure et anti-jointure faites par SQLite (clés primaires des deux tables).
+        Returns (files_to_download, total_bytes, deleted_files).
+        """
+        files_to_download = []
+        total_bytes = 0
+        deleted_files = []
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+        
+            cursor.execute('''
+                SELECT r.rel_path, r.size
+                FROM remote_scan r
+                LEFT JOIN file_state f ON f.rel_path = r.rel_path
+                WHERE f.rel_path IS NULL OR f.size <> r.size OR f.modify <> r.modify
+                ORDER BY r.rel_path
+            ''')
             while True:
-                rows = cursor.fetchmany(10000)
+                rows = cursor.fetchmany(batch_size)
                 if not rows:
                     break
-                for row in rows:
-                    if row['rel_path'] not in remote_paths:
-                        deleted_files.add(row['rel_path'])
-
+                files_to_download.extend(rows)
+                total_bytes += sum(size for rel_path, size in rows)
+        
+            cursor.execute('''
+                SELECT f.rel_path
+                FROM file_state f
+                WHERE NOT EXISTS (SELECT 1 FROM remote_scan r WHERE r.rel_path = f.rel_path)
+                ORDER BY f.rel_path
+            ''')
+            deleted_files = [row[0] for row in cursor]
+        
         return files_to_download, total_bytes, deleted_files
 
+    def diff_against_remote(self, remote_files):
+        """
+        Charge un scan distant dans remote_scan puis le compare à file_state en SQL.
+        Accepte un dict ou un itérable de tuples (rel_path, size, modify) :
+        le scan n'a pas besoin d'exister en entier en mémoire.
+        Returns (files_to_download, total_bytes, deleted_files), comme find_files_to_download.
+        """
+        self.load_remote_scan(remote_files)
+        return self.find_files_to_download_scan()
+
+    def delete_missing_from_scan(self) -> int:
+        """
+        Supprime de file_state les fichiers absents du dernier scan (remote_scan) :
+        une anti-jointure exécutée par SQLite, sans renvoyer les chemins en Python.
+        Retourne le nombre de lignes supprimées.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.execute('''
+                DELETE FROM file_state
+                WHERE NOT EXISTS (SELECT 1 FROM remote_scan r WHERE r.rel_path = file_state.rel_path)
+            ''')
+            conn.commit()
+            return cursor.rowcount
+
+    def commit_remote_scan(self):
+        """Enregistre tout le dernier scan (remote_scan) comme état synchronisé, puis vide la table"""
+        timestamp = datetime.now().isoformat()
+        
+        with self._get_connection() as conn:
+            # WHERE true : lève l'ambiguïté INSERT … SELECT … ON CONFLICT
+            conn.execute('''
+                INSERT INTO file_state (rel_path, size, modify, last_sync, status)
+                SELECT rel_path, size, modify, ?, 'synced' FROM remote_scan WHERE true
+                ON CONFLICT(rel_path) DO UPDATE SET
+                    size = excluded.size,
+                    modify = excluded.modify,
+                    last_sync = excluded.last_sync,
+                    status = 'synced'
+            ''', (timestamp,))
+            conn.execute('DELETE FROM remote_scan')
+            conn.commit()
+
+    @staticmethod
+    def _upsert_rows(cursor, rows: List[Tuple[str, int, str, str]]):
+        """UPSERT de lignes (rel_path, size, modify, last_sync) par statements multi-VALUES"""
+        for i in range(0, len(rows), UPSERT_ROWS_PER_STATEMENT):
+            chunk = rows[i:i + UPSERT_ROWS_PER_STATEMENT]
+            cursor.execute(_upsert_sql(len(chunk)), list(chain.from_iterable(chunk)))
+
     def update_file_batch(self, files: Dict[str, Dict], batch_size: int = 1000):
         """
         Met à jour plusieurs fichiers en batch (beaucoup plus rapide)
         
         Args:
             files: Dict avec {rel_path: {'size': ..., 'modify': ...}}
-            batch_size: Nombre de fichiers par transaction
+            batch_size: Nombre de lignes passées à chaque executemany
+                        (une seule transaction pour tout l'appel)
         """
         timestamp = datetime.now().isoformat()
         
         with self._get_connection() as conn:
             cursor = conn.cursor()
             
-            file_list = list(files.items())
-            total_batches = (len(file_list) + batch_size - 1) // batch_size
-            
-            for batch_num in range(total_batches):
-                start_idx = batch_num * batch_size
-                end_idx = min(start_idx + batch_size, len(file_list))
-                batch = file_list[start_idx:end_idx]
-                
+            for batch in iter_chunks(files.items(), batch_size):
                 # UPSERT batch
-                cursor.executemany('''
-                    INSERT INTO file_state (rel_path, size, modify, last_sync, status)
-                    VALUES (?, ?, ?, ?, 'synced')
-                    ON CONFLICT(rel_path) DO UPDATE SET
-                        size = excluded.size,
-                        modify = excluded.modify,
-                        last_sync = excluded.last_sync,
-                        status = 'synced'
-                ''', [
+                self._upsert_rows(cursor, [
                     (rel_path, info['size'], info['modify'], timestamp)
                     for rel_path, info in batch
                 ])
-                
+            
+            conn.commit()
+    
+    def update_file_batch_iter(self, rows: Iterable[Tuple[str, int, str]], batch_size: int = 1000) -> int:
+        """
+        Variante de update_file_batch prenant directement des tuples
+        (rel_path, size, modify), sans construire de dict. Retourne le nombre de lignes.
+        """
+        timestamp = datetime.now().isoformat()
+        count = 0
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            
+            for batch in iter_chunks(rows, batch_size):
+                self._upsert_rows(cursor, [
+                    (rel_path, size, modify, timestamp)
+                    for rel_path, size, modify in batch
+                ])
+                count += len(batch)
+            
+            conn.commit()
+        
+        return count
+    
+    def convert_iso_modify_to_epoch(self) -> int:
+        """
+        Convertit les dates 'modify' au format ISO local (anciens états de
+        deploy) en epoch secondes, le format produit par get_local_files.
+        Retourne le nombre de lignes converties.
+        """
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT rel_path, modify FROM file_state WHERE modify LIKE '____-__-__T%'")
+            
+            updates = []
+            for row in cursor.fetchall():
+                try:
+                    epoch = int(datetime.fromisoformat(row['modify']).timestamp())
+                except ValueError:
+                    continue
+                updates.append((str(epoch), row['rel_path']))
+            
+            if updates:
+                cursor.executemany('UPDATE file_state SET modify = ? WHERE rel_path = ?', updates)
                 conn.commit()
+        
+        return len(updates)
+    
+    def get_files_in_directory(self, rel_dir: str) -> Dict[str, Dict]:
+        """Fichiers directement contenus dans un dossier (parcours de plage sur l'index)"""
+        prefix = rel_dir + '/' if rel_dir else ''
+        files = {}
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            if prefix:
+                # '0' suit immédiatement '/' : la plage couvre tout le sous-arbre
+                cursor.execute(
+                    'SELECT rel_path, size, modify FROM file_state WHERE rel_path >= ? AND rel_path < ?',
+                    (prefix, prefix[:-1] + '0')
+                )
+            else:
+                cursor.execute('SELECT rel_path, size, modify FROM file_state')
+            
+            for row in cursor:
+                if '/' not in row['rel_path'][len(prefix):]:
+                    files[row['rel_path']] = {'size': row['size'], 'modify': row['modify']}
+        return files
+    
+    def get_directory_states(self, max_age_hours: int = 24) -> Dict[str, Dict]:
+        """
+        Listings de dossiers encore considérés comme frais
+        Returns: {rel_dir: {'modify': ..., 'last_listed': ...}}
+        """
+        cutoff = (datetime.now() - timedelta(hours=max_age_hours)).isoformat()
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT rel_path, modify, last_listed FROM dir_state WHERE last_listed >= ?',
+                (cutoff,)
+            )
+            return {
+                row['rel_path']: {'modify': row['modify'], 'last_listed': row['last_listed']}
+                for row in cursor.fetchall()
+            }
+    
+    def save_directory_states(self, dir_states: Dict[str, Dict]):
+        """Remplace le cache des listings de dossiers par celui du dernier scan"""
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM dir_state')
+            cursor.executemany(
+                'INSERT INTO dir_state (rel_path, modify, last_listed) VALUES (?, ?, ?)',
+                [(rel_dir, info['modify'], info['last_listed']) for rel_dir, info in dir_states.items()]
+            )
+            conn.commit()
     
     def delete_files(self, rel_paths: List[str], batch_size: int = 1000):
         """Supprime plusieurs fichiers en batch"""
@@ -224,14 +661,30 @@ class StateManager:
         """Crée un checkpoint pour la reprise"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO sync_checkpoints 
-                (sync_id, timestamp, files_processed, files_total, bytes_transferred, status)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (sync_id, datetime.now().isoformat(), files_processed, 
-                  files_total, bytes_transferred, status))
+            cursor.execute(_CHECKPOINT_SQL, (sync_id, datetime.now().isoformat(), files_processed, 
+                                             files_total, bytes_transferred, status))
             conn.commit()
     
+    def checkpoint_writer(self) -> 'CheckpointWriter':
+        """Writer de checkpoints en arrière-plan (à utiliser en context manager)"""
+        return CheckpointWriter(self)
+    
+    def wal_checkpoint(self, mode: str = 'PASSIVE'):
+        """
+        Reporte le WAL dans la base (PASSIVE, FULL, RESTART ou TRUNCATE).
+        Appelé aux frontières de phase, pas pendant les téléchargements.
+        """
+        with self._get_connection() as conn:
+            conn.execute(f'PRAGMA wal_checkpoint({mode})')
+    
+    def optimize(self):
+        """
+        PRAGMA optimize : ANALYZE ciblé des tables dont les statistiques sont
+        périmées (peu coûteux, à appeler en fin de run plutôt qu'à chaque connexion)
+        """
+        with self._get_connection() as conn:
+            conn.execute('PRAGMA optimize')
+    
     def get_last_checkpoint(self, sync_id: str) -> Optional[Dict]:
         """Récupère le dernier checkpoint pour reprendre"""
         with self._get_connection() as conn:
@@ -257,6 +710,31 @@ class StateManager:
             ''', (sync_id, datetime.now().isoformat(), rel_path, error_message, retry_count))
             conn.commit()
     
+    def log_errors_batch(self, errors: Iterable[Tuple[str, str, str, int]], batch_size: int = 1000) -> int:
+        """
+        Log plusieurs erreurs en une transaction (executemany).
+        errors : tuples (sync_id, rel_path, error_message, retry_count). Retourne le nombre de lignes.
+        """
+        timestamp = datetime.now().isoformat()
+        count = 0
+        
+        with self._get_connection() as conn:
+            cursor = conn.cursor()
+            
+            for batch in iter_chunks(errors, batch_size):
+                cursor.executemany('''
+                    INSERT INTO sync_errors (sync_id, timestamp, rel_path, error_message, retry_count)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [
+                    (sync_id, timestamp, rel_path, error_message, retry_count)
+                    for sync_id, rel_path, error_message, retry_count in batch
+                ])
+                count += len(batch)
+            
+            conn.commit()
+        
+        return count
+    
     def get_errors(self, sync_id: str) -> List[Dict]:
         """Récupère toutes les erreurs d'une synchro"""
         with self._get_connection() as conn:
@@ -271,18 +749,13 @@ class StateManager:
         """Récupère des statistiques sur la base"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = None
             
-            # Nombre total de fichiers
-            cursor.execute('SELECT COUNT(*) as count FROM file_state')
-            total_files = cursor.fetchone()['count']
-            
-            # Taille totale
-            cursor.execute('SELECT SUM(size) as total FROM file_state')
-            total_size = cursor.fetchone()['total'] or 0
-            
-            # Dernier sync
-            cursor.execute('SELECT MAX(last_sync) as last FROM file_state')
-            last_sync = cursor.fetchone()['last']
+            # Nombre, taille totale et dernier sync en un seul parcours de la
+            # table (trois requêtes en faisaient trois)
+            cursor.execute('SELECT COUNT(*), SUM(size), MAX(last_sync) FROM file_state')
+            total_files, total_size, last_sync = cursor.fetchone()
+            total_size = total_size or 0
             
             # Taille de la base
             db_size = os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
@@ -301,18 +774,97 @@ class StateManager:
             conn.execute('VACUUM')
     
     def export_to_json(self, output_path: str):
-        """Exporte vers JSON pour migration/backup"""
+        """
+        Exporte vers JSON pour migration/backup ({rel_path: {size, modify, checksum}},
+        le format des anciens états). Écrit en flux, compact et trié par chemin :
+        ni dict complet en mémoire, ni indentation (fichier plus petit, diffable).
+        """
         import json
         
-        files = self.get_all_files()
-        with open(output_path, 'w') as f:
-            json.dump(files, f, indent=2)
+        encode = json.JSONEncoder(separators=(',', ':')).encode
+        with self._get_connection() as conn, open(output_path, 'w', encoding='utf-8') as f:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute('SELECT rel_path, size, modify, checksum FROM file_state ORDER BY rel_path')
+            
+            f.write('{')
+            separator = ''
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                f.write(separator)
+                f.write(','.join(
+                    f'{encode(rel_path)}:{{"size":{encode(size)},"modify":{encode(modify)},'
+                    f'"checksum":{encode(checksum)}}}'
+                    for rel_path, size, modify, checksum in rows
+                ))
+                separator = ','
+            f.write('}')
     
     def import_from_json(self, json_path: str):
         """Importe depuis un ancien state JSON"""
-        import json
-        
-        with open(json_path, 'r') as f:
-            files = json.load(f)
-        
-        self.update_file_batch(files)
\ No newline at end of file
+        with open(json_path, 'rb') as f:
+            self.update_file_batch_iter(iter_json_state(f))
+
+class CheckpointWriter:
+    """
+    Checkpoints de progression écrits par un thread dédié : l'appelant (boucle
+    de progression des téléchargements) ne fait qu'un put(), sans ouvrir de
+    connexion ni attendre le commit. Les enregistrements en attente sont
+    regroupés (jusqu'à max_batch) dans une seule transaction.
+    close() (ou la sortie du with) attend que tout soit écrit.
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, state_manager: StateManager, max_batch: int = 100):
+        self.state_manager = state_manager
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+    
+    def put(self, sync_id: str, files_processed: int, files_total: int,
+            bytes_transferred: int, status: str = 'in_progress'):
+        """Même signature que StateManager.create_checkpoint, sans attente"""
+        self._queue.put_nowait((sync_id, datetime.now().isoformat(), files_processed,
+                                files_total, bytes_transferred, status))
+    
+    def close(self):
+        """Écrit les checkpoints en attente puis arrête le thread"""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+    
+    def _run(self):
+        # Connexion propre au thread, gardée ouverte jusqu'à l'arrêt
+        with self.state_manager._get_connection() as conn:
+            stopping = False
+            while not stopping:
+                batch = [self._queue.get()]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                
+                if batch[-1] is self._STOP:  # rien n'est mis en file après l'arrêt
+                    batch.pop()
+                    stopping = True
+                if not batch:
+                    continue
+                
+                try:
+                    conn.executemany(_CHECKPOINT_SQL, batch)
+                    conn.commit()
+                except sqlite3.Error as e:
+                    # Checkpoints de reprise : un échec ne doit pas arrêter le backup
+                    conn.rollback()
+                    logger.warning(f"Checkpoint write failed: {e}")
@@ -8,10 +8,29 @@ import tarfile
 import logging
 import time
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional, Callable, Dict
+from modules.checksum_utils import verify_sizes_bulk
+from modules.linux_optimized import stat_light
 
 logger = logging.getLogger(__name__)
 
+# Écriture des petits fichiers extraits déléguée à quelques threads : le
+# thread de lecture continue de décompresser le flux pendant open/write/close.
+EXTRACT_WRITERS = 4
+EXTRACT_INLINE_MIN = 1024 * 1024  # au-delà, écriture en flux dans le thread de lecture
+EXTRACT_MAX_PENDING = 64  # ≤ 64 MB de contenu en attente d'écriture
+
+# Rafraîchissement de la progression pendant l'extraction : au plus 10 fois par seconde
+PROGRESS_MIN_INTERVAL = 0.1
+
+
+def _write_extracted(local_path: str, data: bytes):
+    """Écrit le contenu d'un membre tar (thread d'écriture)"""
+    with open(local_path, 'wb') as out:
+        out.write(data)
+
 
 class TarStreamDownloader:
     """
@@ -403,7 +422,40 @@ class TarStreamDownloader:
         # Detect tar mode from command flags
         tar_mode = 'r|gz' if 'z' in cmd.split()[1] else 'r|'
 
-        with tarfile.open(fileobj=stdout, mode=tar_mode) as tar:
+        pending = deque()  # (member_name, size, future) dans l'ordre du flux
+        last_report = 0.0
+
+        def record(member_name, size, error=None):
+            nonlocal last_report
+            if error is not None:
+                logger.warning(f"Extract failed: {member_name}: {error}")
+                self.stats['errors'].append(member_name)
+                return
+
+            self.stats['files_extracted'] += 1
+            self.stats['bytes_transferred'] += size
+
+            # Petits fichiers : des milliers par seconde, l'affichage n'a pas à suivre
+            if progress_callback and self.stats['files_extracted'] % 100 == 0:
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_MIN_INTERVAL:
+                    last_report = now
+                    progress_callback(
+                        self.stats['files_extracted'],
+                        expected_total,
+                        self._get_speed_stats()
+                    )
+
+        def reap(limit):
+            while len(pending) > limit:
+                member_name, size, future = pending.popleft()
+                error = future.exception()
+                record(member_name, size, error)
+
+        local_prefix = os.path.join(self.local_root, '')
+
+        with ThreadPoolExecutor(max_workers=EXTRACT_WRITERS) as writers, \
+                tarfile.open(fileobj=stdout, mode=tar_mode) as tar:
             for member in tar:
                 if self._stop:
                     break
@@ -412,17 +464,26 @@ class TarStreamDownloader:
 
                 if not member.isfile():
                     if member.isdir() and member_name:
-                        self._ensure_dir(os.path.join(self.local_root, member_name))
+                        self._ensure_dir(local_prefix + member_name)
                     continue
 
                 if not member_name:
                     continue
 
                 try:
-                    local_path = os.path.join(self.local_root, member_name)
+                    local_path = local_prefix + member_name
                     self._ensure_dir(os.path.dirname(local_path))
 
                     source = tar.extractfile(member)
+                    if source and member.size < EXTRACT_INLINE_MIN:
+                        # Le contenu doit être lu ici (flux séquentiel), l'écriture part au pool
+                        data = source.read()
+                        source.close()
+                        pending.append((member_name, member.size,
+                                        writers.submit(_write_extracted, local_path, data)))
+                        reap(EXTRACT_MAX_PENDING)
+                        continue
+
                     if source:
                         with open(local_path, 'wb') as out:
                             while True:
@@ -432,19 +493,12 @@ class TarStreamDownloader:
                                 out.write(chunk)
                         source.close()
 
-                    self.stats['files_extracted'] += 1
-                    self.stats['bytes_transferred'] += member.size
-
-                    if progress_callback and self.stats['files_extracted'] % 100 == 0:
-                        progress_callback(
-                            self.stats['files_extracted'],
-                            expected_total,
-                            self._get_speed_stats()
-                        )
+                    record(member_name, member.size)
 
                 except Exception as e:
-                    logger.warning(f"Extract failed: {member_name}: {e}")
-                    self.stats['errors'].append(member_name)
+                    record(member_name, member.size, e)
+
+            reap(0)
 
         # Final progress callback
         if progress_callback:
@@ -511,29 +565,40 @@ class TarStreamDownloader:
             'elapsed': elapsed,
         }
 
-    def verify_extraction(self, expected_files: Dict[str, int]) -> List[str]:
+    def verify_extraction(self, expected_files) -> List[str]:
         """
-        Verify extracted files exist and match expected sizes.
+        Verify extracted files exist and match expected sizes exactly
+        (verify_sizes_bulk): a truncated tar member is never accepted.
 
         Args:
-            expected_files: {rel_path: expected_size}
+            expected_files: {rel_path: expected_size}, or an iterable of
+                            (rel_path, expected_size) pairs
 
         Returns:
             List of rel_paths that failed verification
         """
-        failed = []
-        for rel_path, expected_size in expected_files.items():
-            local_path = os.path.join(self.local_root, rel_path)
-            if not os.path.exists(local_path):
-                failed.append(rel_path)
-            elif expected_size > 0:
-                try:
-                    actual = os.path.getsize(local_path)
-                    if actual != expected_size:
-                        failed.append(rel_path)
-                except OSError:
-                    failed.append(rel_path)
-        return failed
+        if hasattr(expected_files, 'items'):
+            expected_files = expected_files.items()
+
+        # Un seul statx par fichier (taille seule, attributs en cache), préfixe calculé une fois.
+        # Tailles relevées en colonnes, puis comparées en une seule passe
+        local_prefix = os.path.join(self.local_root, '')
+        rel_paths = []
+        expected_sizes = []
+        local_sizes = []
+        for rel_path, expected_size in expected_files:
+            rel_paths.append(rel_path)
+            expected_sizes.append(expected_size)
+            try:
+                local_sizes.append(stat_light(local_prefix + rel_path)[0])
+            except OSError:
+                local_sizes.append(None)
+
+        return [
+            rel_path
+            for rel_path, ok in zip(rel_paths, verify_sizes_bulk(local_sizes, expected_sizes))
+            if not ok
+        ]
 
     def stop(self):
         self._stop = True
@@ -242,10 +242,14 @@ Examples:
         parser.add_argument('--remote', help='Remote project name (alias for -distant_folder)')
         parser.add_argument('--dry-run', action='store_true', help='Dry-run mode for deploy')
         parser.add_argument('--no-verify', action='store_true', help='Skip integrity verification')
+        parser.add_argument('--verify-hash', action='store_true',
+                            help='Optimized backup over SFTP: also compare MD5 hashes with the server (one SSH command per batch)')
         parser.add_argument('--no-exclude', action='store_true', help='Do not exclude cache/logs')
         parser.add_argument('--no-incremental', action='store_true', help='Disable incremental scan')
-        parser.add_argument('--workers', type=int, default=None, help='Number of parallel workers (overrides -speed)')
+        parser.add_argument('--workers', type=int, default=None, help='Number of parallel workers (overrides -speed; enables parallel downloads in classic backup)')
         parser.add_argument('--checkpoint', type=int, default=1000, help='Checkpoint interval (default: 1000)')
+        parser.add_argument('--cache-dirs', action='store_true',
+                            help='Classic backup: skip re-listing remote directories whose modify date is unchanged (re-listed at least every 24h)')
         args = parser.parse_args()
 
         # Resolve local/remote from either flag style
@@ -282,7 +286,8 @@ Examples:
                 'exclude_patterns': bool(args.ignore_log_cache_temp) and not args.no_exclude,
                 'verify_integrity': bool(args.verify_integrity) and not args.no_verify,
                 'handle_deletions': bool(args.handle_deleted),
-                'parallel_downloads': 0,
+                'parallel_downloads': args.workers or 0,
+                'cache_dir_listings': args.cache_dirs,
             }
             tool.backup(local_path, remote_name, options)
 
@@ -307,6 +312,7 @@ Examples:
                 'num_workers': workers,
                 'use_incremental_scan': bool(args.auto_increment) and not args.no_incremental,
                 'checkpoint_interval': args.checkpoint,
+                'hash_verification': args.verify_hash and bool(args.verify_integrity) and not args.no_verify,
             }
 
             console.print(f"[bold green]CLI: Starting optimized backup with {workers} workers...[/bold green]")
@@ -321,7 +327,10 @@ Examples:
             if not local_path or not remote_name:
                 console.print("[red]Error: -target and -distant_folder (or --local and --remote) are required[/red]")
                 sys.exit(1)
-            tool.deploy(local_path, remote_name, dry_run=args.dry_run)
+            if args.workers is not None:
+                tool.deploy(local_path, remote_name, dry_run=args.dry_run, num_workers=args.workers)
+            else:
+                tool.deploy(local_path, remote_name, dry_run=args.dry_run)
 
         elif args.action == 'migrate':
             os.system('python migrate_state.py')